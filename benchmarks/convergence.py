@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+convergence: measure how long a cluster of nodes takes to discover itself,
+for a range of discovery settings.
+
+For each setting, starts N nodes on this host at once and reports the time
+until every node sees the other N - 1 as peers.
+
+    $ ./convergence.py --nodes 20
+    $ ./convergence.py --nodes 50 --interface lo --port 5680
+
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+
+from aiozyre import Node
+
+
+def settings(args):
+    ports = itertools.count(args.base_port)
+    for interval in (1000, 250, 100):
+        yield 'beacon, interval %dms' % interval, lambda i, interval=interval: dict(
+            port=args.port, beacon_interval_ms=interval, interface=args.interface)
+
+    # Gossip: hub nodes bind, every node connects to every hub. Beacons are off.
+    for hubs in (1, 2):
+        endpoints = ['tcp://127.0.0.1:%d' % next(ports) for _ in range(hubs)]
+        yield 'gossip, %d hub(s)' % hubs, lambda i, endpoints=endpoints: dict(
+            endpoint='tcp://127.0.0.1:%d' % next(ports),
+            gossip_bind=endpoints[i] if i < len(endpoints) else None,
+            gossip_connect=[endpoint for j, endpoint in enumerate(endpoints) if j != i])
+
+
+async def converge(count, kwargs_for, timeout):
+    nodes = [Node('node%d' % i, **kwargs_for(i)) for i in range(count)]
+    started_at = time.monotonic()
+    await asyncio.gather(*(node.start() for node in nodes))
+    startup = time.monotonic() - started_at
+    try:
+        pending = set(nodes)
+        while pending and time.monotonic() - started_at < timeout:
+            for node in list(pending):
+                if len(await node.peers()) == count - 1:
+                    pending.remove(node)
+            await asyncio.sleep(0.01)
+        converged = time.monotonic() - started_at if not pending else None
+    finally:
+        await asyncio.gather(*(node.stop() for node in nodes))
+    return startup, converged
+
+
+async def main(args):
+    print('%-28s %10s %12s' % ('setting', 'start (s)', 'converge (s)'))
+    for name, kwargs_for in settings(args):
+        startup, converged = await converge(args.nodes, kwargs_for, args.timeout)
+        print('%-28s %10.3f %12s' % (
+            name, startup, 'timeout' if converged is None else '%.3f' % converged))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure cluster discovery time for each discovery setting')
+    parser.add_argument('--nodes', type=int, default=10, help='Nodes per cluster')
+    parser.add_argument('--interface', type=str, default=None, help='Network interface for beacons')
+    parser.add_argument('--port', type=int, default=5670, help='UDP port for beacons')
+    parser.add_argument('--base-port', type=int, default=49152, help='First TCP port for gossip endpoints')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for each cluster to converge')
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
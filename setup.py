@@ -10,6 +10,9 @@ from setuptools.command.install import install as _install
 
 DIR = os.path.dirname(__file__)
 
+# Set AIOZYRE_DRAFT_API=1 to build against zyre's draft API (zyre built with --enable-drafts)
+DRAFT_API = os.environ.get('AIOZYRE_DRAFT_API') == '1'
+
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
@@ -89,10 +92,16 @@ setup(
             module,
             sources=[source],
             libraries=['czmq', 'zyre'],
+            define_macros=[('ZYRE_BUILD_DRAFT_API', '1')] if DRAFT_API else [],
         )
         for module, source in get_pyx()
     ],
     setup_requires=['cython'],
+    entry_points={
+        'console_scripts': [
+            'aiozyre-load = aiozyre.load:main',
+        ],
+    },
     extras_require={
         'dev': [
             'blessed',
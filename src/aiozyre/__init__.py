@@ -1,7 +1,14 @@
 
+from .blocking import BlockingNode
 from .messages import Msg
-from .node import Node
-from .exceptions import StartFailed, Stopped, StopFailed
+from .mesh import Mesh
+from .node import Node, StopReport
+from .spool import Spool
+from .state import GroupState
+from .exceptions import StartFailed, Stopped, StopFailed, Unreachable
 
 
-__all__ = ['Msg', 'Node', 'StartFailed', 'StopFailed', 'Stopped']
+__all__ = [
+    'BlockingNode', 'GroupState', 'Mesh', 'Msg', 'Node', 'Spool', 'StartFailed', 'StopFailed', 'StopReport',
+    'Stopped', 'Unreachable',
+]
@@ -0,0 +1,164 @@
+import collections
+import queue
+import threading
+import time
+
+from typing import List, Optional, Set, Union
+
+from . import envelopes
+from . import futures
+from . import messages
+from . import spool
+from .exceptions import Stopped
+
+
+class BlockingNode:
+    """
+    Thread-safe, synchronous facade over a started Node, for callers which aren't asyncio code,
+    such as worker threads.
+
+    Commands are handed straight to the node's zactor thread, without a trip through the event
+    loop, and each call blocks until the zactor thread has carried the command out, raising
+    TimeoutError if that takes longer than timeout seconds. Any number of threads may share a
+    BlockingNode, and the node remains usable from asyncio code at the same time.
+
+    If receive is true, incoming messages go to a thread-safe queue read by recv() instead of to
+    Node.recv(). Traced and batched whispers are unwrapped as Node.recv() would, without recording
+    trace histograms; aiozyre's other protocol messages (pings, reliable whispers, ...) are handed
+    to the Node's filters on the event loop thread, and whatever those deliver is then returned by
+    recv(). GroupState and Spool need to see every message, so they can't be attached to the node.
+
+    Applies to the node's current run; create a new BlockingNode if the node is restarted.
+    """
+
+    def __init__(self, node, *, receive: bool = False, timeout: float = None):
+        if not node.running:
+            raise Stopped('Node not running')
+        self.node = node
+        self.timeout = timeout
+        self.outbox = None
+        # Messages taken from the outbox but not yet returned by recv(), e.g. the rest of a batch
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        if receive:
+            builtin = (node.tracer.filter, spool.unbatch, node.stats.filter, node.reliable.filter)
+            if any(f not in builtin for f in node.filters):
+                raise ValueError('Node has filters which must see every message (e.g. GroupState, Spool)')
+            self.outbox = node.actor.sync_outbox = queue.Queue()
+
+    def submit(self, signal: int, **kwargs):
+        if not self.node.running:
+            raise Stopped('Node not running')
+        fut = futures.BlockingFuture(signal, **kwargs)
+        self.node.actor.give_direct(fut)
+        return fut.result(self.timeout)
+
+    def recv(self, timeout: float = None) -> messages.Msg:
+        """
+        Receive next message from network, waiting up to timeout seconds, or raise TimeoutError.
+        """
+        if self.outbox is None:
+            raise RuntimeError('BlockingNode was not created with receive=True')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if self.pending:
+                    return self.pending.popleft()
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                msg = self.outbox.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError('No message received') from None
+            if isinstance(msg, Exception):
+                raise msg
+            msgs = self.filter(msg)
+            if msgs:
+                with self.lock:
+                    self.pending.extend(msgs)
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        """
+        Unwrap traced and batched whispers, and hand other protocol messages to the event loop thread.
+        """
+        if msg.event not in ('SHOUT', 'WHISPER'):
+            return [msg]
+        envelope = envelopes.unpack(msg.blob)
+        if envelope is not None and envelope[0] == envelopes.TRACE:
+            blob = envelope[2]
+            envelope = envelopes.unpack(blob)
+            if envelope is None or envelope[0] == envelopes.BATCH:
+                msg.blob = blob
+        if envelope is None:
+            return [msg]
+        if envelope[0] == envelopes.BATCH:
+            return spool.unbatch(msg)
+        self.node.loop.call_soon_threadsafe(self.relay, msg)
+        return []
+
+    def relay(self, msg: messages.Msg):
+        """
+        Run a protocol message through the Node's filters, queueing whatever they deliver for recv().
+
+        This method is *not* thread safe and should only be called from the event loop thread.
+        """
+        for out in self.node.filter(msg):
+            self.outbox.put(out)
+
+    def shout(self, group: str, blob: Union[bytes, str]):
+        """
+        Send message to a group
+        """
+        if isinstance(blob, str):
+            blob = blob.encode('utf8')
+        self.submit(futures._SHOUT, group=group.encode('utf8'), blob=blob)
+
+    def whisper(self, peer: str, blob: Union[bytes, str]):
+        """
+        Send message to single peer, specified as a UUID string
+        """
+        if isinstance(blob, str):
+            blob = blob.encode('utf8')
+        self.submit(futures._WHISPER, peer=peer.encode('utf8'), blob=blob)
+
+    def join(self, group: str):
+        """
+        Join a named group
+        """
+        self.submit(futures._JOIN, group=group.encode('utf8'))
+
+    def leave(self, group: str):
+        """
+        Leave a named group
+        """
+        self.submit(futures._LEAVE, group=group.encode('utf8'))
+
+    def peers(self) -> Set[str]:
+        """
+        Return set of current peer ids.
+        """
+        return self.submit(futures._PEERS)
+
+    def peers_by_group(self, group: str) -> Set[str]:
+        """
+        Return set of current peers of this group.
+        """
+        return self.submit(futures._PEERS_BY_GROUP, group=group.encode('utf8'))
+
+    def own_groups(self) -> Set[str]:
+        """
+        Return set of currently joined groups.
+        """
+        return self.submit(futures._OWN_GROUPS)
+
+    def peer_groups(self) -> Set[str]:
+        """
+        Return set of groups known through connected peers.
+        """
+        return self.submit(futures._PEER_GROUPS)
+
+    def peer_header_value(self, peer: str, header: str) -> Optional[str]:
+        """
+        Return the value of a header of a connected peer, or None.
+        """
+        return self.submit(futures._PEER_HEADER_VALUE, peer=peer.encode('utf8'), header=header.encode('utf8'))
@@ -0,0 +1,50 @@
+import asyncio
+import collections
+
+from typing import Any, Callable, Hashable, Optional
+
+
+class ConflatingQueue(asyncio.Queue):
+    """
+    A queue which keeps only the latest item for each key.
+
+    key(item) returns the item's key, or None for items which must never be conflated.
+    Putting an item whose key is already queued replaces the queued item in place, so
+    it keeps the position of the first one and the queue holds at most one item per key.
+    """
+
+    def __init__(self, key: Callable[[Any], Optional[Hashable]], maxsize: int = 0):
+        self.key = key
+        # Number of items replaced by a later item with the same key
+        self.conflated = 0
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        # (key, [item]) in order of arrival
+        self._queue = collections.deque()
+        # key -> [item], for keyed items in the queue
+        self._slots = {}
+
+    def put_nowait(self, item):
+        key = self.key(item)
+        if key is not None:
+            slot = self._slots.get(key)
+            if slot is not None:
+                # Replaced, not added: nothing for a getter to wake up for, and no extra task_done() due
+                slot[0] = item
+                self.conflated += 1
+                return
+        super().put_nowait((key, item))
+
+    def _put(self, entry):
+        key, item = entry
+        slot = [item]
+        if key is not None:
+            self._slots[key] = slot
+        self._queue.append((key, slot))
+
+    def _get(self):
+        key, slot = self._queue.popleft()
+        if key is not None:
+            del self._slots[key]
+        return slot[0]
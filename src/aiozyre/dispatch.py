@@ -0,0 +1,96 @@
+import asyncio
+import collections
+import inspect
+import logging
+
+from typing import Callable
+
+from . import messages
+from .exceptions import Stopped
+
+
+logger = logging.getLogger('aiozyre')
+
+
+class Dispatcher:
+    """
+    Routes messages received by a Node to handlers registered for (event, group) pairs.
+
+    Messages from the same peer are handled one at a time, in the order they were received,
+    while messages from different peers are handled concurrently, up to `concurrency` at once.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        # (event, group or None) -> list of handlers
+        self.handlers = {}
+        # peer -> deque of (msg, handlers) waiting for that peer's worker
+        self.queues = {}
+        # peer -> worker task
+        self.workers = {}
+        self.running = None
+        self.capacity = None
+
+    def register(self, handler: Callable, event: str, group: str = None):
+        """
+        Call handler(msg) for messages with the given event; if group is None, for every group.
+        The handler may be a plain function or a coroutine function.
+        """
+        self.handlers.setdefault((event, group), []).append(handler)
+
+    def unregister(self, handler: Callable, event: str, group: str = None):
+        handlers = self.handlers.get((event, group))
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+            if not handlers:
+                del self.handlers[(event, group)]
+
+    def lookup(self, msg: messages.Msg) -> list:
+        handlers = self.handlers.get((msg.event, msg.group or None), [])
+        if msg.group:
+            handlers = handlers + self.handlers.get((msg.event, None), [])
+        return handlers
+
+    async def run(self, *, concurrency: int = 16, max_pending: int = 1024):
+        """
+        Receive messages from the node and dispatch them to handlers until the node stops.
+        Waits for queued messages to be handled before returning.
+
+        At most max_pending messages are buffered; beyond that, receiving waits for handlers to catch up.
+        """
+        self.running = asyncio.Semaphore(concurrency)
+        self.capacity = asyncio.Semaphore(max_pending)
+        while True:
+            await self.capacity.acquire()
+            try:
+                msg = await self.node.recv()
+            except Stopped:
+                break
+            handlers = self.lookup(msg)
+            if not handlers:
+                self.capacity.release()
+                continue
+            queue = self.queues.get(msg.peer)
+            if queue is None:
+                queue = self.queues[msg.peer] = collections.deque()
+                self.workers[msg.peer] = asyncio.ensure_future(self.work(msg.peer, queue))
+            queue.append((msg, handlers))
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()))
+
+    async def work(self, peer: str, queue: collections.deque):
+        try:
+            while queue:
+                msg, handlers = queue.popleft()
+                async with self.running:
+                    for handler in handlers:
+                        try:
+                            result = handler(msg)
+                            if inspect.isawaitable(result):
+                                await result
+                        except Exception as exc:
+                            logger.exception(exc)
+                self.capacity.release()
+        finally:
+            del self.queues[peer]
+            del self.workers[peer]
@@ -0,0 +1,37 @@
+from typing import List, Optional, Tuple
+
+
+# Envelopes wrap the blobs of aiozyre's own protocols (reliable whispers, pings, ...) so that they
+# can be told apart from application messages. zyre sends blobs as C strings, so an envelope must
+# never contain NUL bytes: fields are ASCII and are separated from the payload by a newline.
+#
+#     PREFIX kind field field ...\n payload
+PREFIX = b'\x1eAZ'
+
+RELIABLE_DATA = b'D'
+RELIABLE_ACK = b'A'
+PING = b'P'
+PONG = b'O'
+STATE_DELTA = b'U'
+STATE_SNAPSHOT = b'S'
+STATE_REQUEST = b'Q'
+TRACE = b'T'
+BATCH = b'B'
+
+
+def pack(kind: bytes, *fields, payload: bytes = b'') -> bytes:
+    return b'%s%s %s\n%s' % (PREFIX, kind, ' '.join(str(field) for field in fields).encode('ascii'), payload)
+
+
+def unpack(blob: bytes) -> Optional[Tuple[bytes, List[str], bytes]]:
+    """
+    Return (kind, fields, payload) for an envelope, or None if blob is an application message.
+    """
+    if not blob.startswith(PREFIX):
+        return None
+    end = blob.find(b'\n')
+    if end == -1:
+        return None
+    kind = blob[len(PREFIX):len(PREFIX) + 1]
+    fields = blob[len(PREFIX) + 1:end].decode('ascii').split()
+    return kind, fields, blob[end + 1:]
@@ -13,3 +13,7 @@ class StopFailed(AIOZyreError):
 
 class Stopped(AIOZyreError):
     pass
+
+
+class Unreachable(AIOZyreError):
+    pass
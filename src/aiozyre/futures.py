@@ -1,5 +1,7 @@
 
 import asyncio
+import threading
+import time
 
 
 _SHOUT = 0
@@ -36,8 +38,9 @@ class ThreadSafeFuture:
         Set the future result.
 
         This method can be called from any thread but is not guaranteed to set the result immediately.
+        If the future is done in the meantime, the result is discarded.
         """
-        self._loop.call_soon_threadsafe(self.future.set_result, result)
+        self._loop.call_soon_threadsafe(self._settle, self.future.set_result, result)
 
     def cancel(self, *args, **kwargs):
         """
@@ -105,12 +108,14 @@ class ThreadSafeFuture:
         """
         Mark the future done and set an exception.
 
-        If the future is already done when this method is called, raises
-        InvalidStateError.
-
         This method can be called from any thread but is not guaranteed to set the exception immediately.
+        If the future is done in the meantime, the exception is discarded.
         """
-        self._loop.call_soon_threadsafe(self.future.set_exception, exception)
+        self._loop.call_soon_threadsafe(self._settle, self.future.set_exception, exception)
+
+    def _settle(self, setter, value):
+        if not self.future.done():
+            setter(value)
 
     def __await__(self):
         return self.future.__await__()
@@ -122,6 +127,46 @@ class ThreadSafeFuture:
         return self.future.__iter__()
 
 
+class BlockingFuture:
+    """
+    Future for callers outside the event loop, completed directly by the zactor thread
+    and waited on with a threading.Event.
+
+    Carries its signal and the signal's arguments (e.g. group and blob for _SHOUT) like
+    the SignalFuture subclasses, already encoded.
+    """
+
+    def __init__(self, signal: int, **kwargs):
+        self.signal = signal
+        self.queued_at = time.time()
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout: float = None):
+        """
+        Wait up to timeout seconds for the result, raising TimeoutError if it isn't available by then.
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError('Timed out waiting for the zactor thread')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
 class StartedFuture(ThreadSafeFuture):
     pass
 
@@ -136,6 +181,7 @@ class ShoutFuture(SignalFuture):
     def __init__(self, *, group: str, blob: bytes, **kwargs):
         self.group = group.encode('utf8')
         self.blob = blob
+        self.queued_at = time.time()
         super().__init__(**kwargs)
 
 
@@ -145,6 +191,7 @@ class WhisperFuture(SignalFuture):
     def __init__(self, *, peer: str, blob: bytes, **kwargs):
         self.peer = peer.encode('utf8')
         self.blob = blob
+        self.queued_at = time.time()
         super().__init__(**kwargs)
 
 
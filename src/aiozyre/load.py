@@ -0,0 +1,328 @@
+"""
+aiozyre-load: a multi-process load generator and soak test.
+
+Launches a number of worker processes on the local host, each running a number of
+nodes which discover each other by gossip over loopback, and has every node send a
+mix of shouts and whispers to the others. Every few seconds, prints the aggregate
+throughput, latency percentiles, resident memory and its growth since the first
+report, and the number of messages dropped or failed to send:
+
+    $ aiozyre-load --workers 4 --nodes 8 --rate 100 --shout-ratio 0.2 --sizes 64,4096
+    $ aiozyre-load --duration 3600 --interval 60
+
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import signal
+import sys
+import time
+
+from typing import Callable, Dict, List, Sequence
+
+from . import tracing
+from .exceptions import AIOZyreError, Stopped
+from .node import Node
+
+# Payloads are 'kind seq timestamp ' followed by padding. zyre sends blobs as C strings,
+# so payloads are NUL-free.
+SHOUT = b'S'
+WHISPER = b'W'
+
+
+def payload(kind: bytes, seq: int, size: int) -> bytes:
+    head = b'%s %d %.6f ' % (kind, seq, time.time())
+    return head + b'.' * max(size - len(head), 0)
+
+
+def rss() -> int:
+    """
+    Resident set size of this process, in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak rather than current size; kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class LoadWorker:
+    """
+    Drives traffic between a set of started nodes, and counts what they send and receive.
+
+    Each node sends `rate` messages per second, each a shout to `group` with probability
+    `shout_ratio` and otherwise a whisper to a random peer, with a size chosen from `sizes`.
+    Messages are numbered per sender (and per recipient for whispers), so that receivers can
+    count the ones which never arrived as dropped.
+    """
+
+    def __init__(
+        self,
+        nodes: List[Node], *,
+        group: str = 'load',
+        rate: float = 10,
+        shout_ratio: float = 0.5,
+        sizes: Sequence[int] = (64, ),
+        seed: int = None
+    ):
+        self.nodes = nodes
+        self.group = group
+        self.rate = rate
+        self.shout_ratio = shout_ratio
+        self.sizes = sizes
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.received = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.errors = 0
+        # A fixed-size histogram rather than every sample, so that long soak runs don't grow
+        self.latencies = tracing.Histogram()
+
+    def report(self) -> Dict:
+        """
+        Return the counts since the last report, and reset them.
+        """
+        report = {
+            'sent': self.sent, 'received': self.received, 'bytes': self.bytes, 'dropped': self.dropped,
+            'errors': self.errors, 'latencies': self.latencies, 'rss': rss(),
+        }
+        self.reset()
+        return report
+
+    async def run(self, *, peers: int, stopping: Callable[[], bool], warmup: float = 30):
+        """
+        Wait up to `warmup` seconds for each node to see `peers` peers, then send
+        and receive until stopping() returns true. Stops the nodes.
+        """
+        loop = asyncio.get_event_loop()
+        known = [set() for _ in self.nodes]
+        listening = [loop.create_task(self.listen(node, known[i])) for i, node in enumerate(self.nodes)]
+        deadline = loop.time() + warmup
+        while any(len(k) < peers for k in known) and loop.time() < deadline and not stopping():
+            await asyncio.sleep(0.1)
+        sending = [loop.create_task(self.send(node, known[i], stopping)) for i, node in enumerate(self.nodes)]
+        await asyncio.wait(sending)
+        for node in self.nodes:
+            await node.stop()
+        await asyncio.wait(listening)
+
+    async def send(self, node: Node, peers: set, stopping: Callable[[], bool]):
+        shouts = 0
+        # peer -> last whisper seq sent to it
+        whispers = {}
+        interval = 1 / self.rate
+        next_at = time.monotonic()
+        while not stopping():
+            next_at += interval
+            await asyncio.sleep(max(next_at - time.monotonic(), 0))
+            size = self.random.choice(self.sizes)
+            try:
+                if not peers or self.random.random() < self.shout_ratio:
+                    shouts += 1
+                    await node.shout(self.group, payload(SHOUT, shouts, size))
+                else:
+                    peer = self.random.choice(sorted(peers))
+                    whispers[peer] = seq = whispers.get(peer, 0) + 1
+                    await node.whisper(peer, payload(WHISPER, seq, size))
+            except AIOZyreError:
+                self.errors += 1
+            else:
+                self.sent += 1
+
+    async def listen(self, node: Node, peers: set):
+        # (peer, kind) -> last seq received
+        last = {}
+        while True:
+            try:
+                msg = await node.recv()
+            except Stopped:
+                break
+            if msg.event == 'ENTER':
+                peers.add(msg.peer)
+            elif msg.event == 'EXIT':
+                peers.discard(msg.peer)
+                last.pop((msg.peer, SHOUT), None)
+                last.pop((msg.peer, WHISPER), None)
+            elif msg.event in ('SHOUT', 'WHISPER'):
+                now = time.time()
+                kind, seq, sent_at, _ = msg.blob.split(b' ', 3)
+                seq = int(seq)
+                previous = last.get((msg.peer, kind))
+                # Shouts sent before this node joined the group don't count as dropped
+                if previous is not None and seq > previous + 1:
+                    self.dropped += seq - previous - 1
+                last[(msg.peer, kind)] = seq
+                self.received += 1
+                self.bytes += len(msg.blob)
+                self.latencies.add(now - float(sent_at))
+
+
+def work(index: int, args: argparse.Namespace, reports: multiprocessing.Queue, stopping: multiprocessing.Event):
+    """
+    Worker process: run args.nodes nodes, putting a report on the reports queue every args.interval seconds.
+    """
+    # Interrupts go to the parent, which tells workers to stop through `stopping`
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    hub = 'tcp://127.0.0.1:%d' % args.base_port
+    nodes = []
+    for i in range(index * args.nodes, (index + 1) * args.nodes):
+        nodes.append(Node(
+            'load%d' % i, groups=[args.group], loop=loop, endpoint='tcp://127.0.0.1:%d' % (args.base_port + 1 + i),
+            gossip_bind=hub if i == 0 else None, gossip_connect=None if i == 0 else hub))
+    worker = LoadWorker(
+        nodes, group=args.group, rate=args.rate, shout_ratio=args.shout_ratio, sizes=args.sizes,
+        seed=None if args.seed is None else args.seed + index)
+    started_at = time.monotonic()
+
+    def done():
+        return stopping.is_set() or (args.duration and time.monotonic() - started_at >= args.duration)
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.interval)
+            reports.put((index, worker.report()))
+
+    async def run():
+        for node in nodes:
+            await node.start()
+        reporting = loop.create_task(report())
+        try:
+            await worker.run(peers=args.workers * args.nodes - 1, stopping=done, warmup=args.warmup)
+        finally:
+            reporting.cancel()
+        reports.put((index, worker.report()))
+        reports.put((index, None))
+
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def merge(report: Dict, later: Dict) -> Dict:
+    """
+    Combine two consecutive reports from the same worker.
+    """
+    merged = {key: report[key] + later[key] for key in ('sent', 'received', 'bytes', 'dropped', 'errors')}
+    merged['latencies'] = report['latencies'].merge(later['latencies'])
+    merged['rss'] = later['rss']
+    return merged
+
+
+def summarize(reports: List[Dict], elapsed: float, memory: int, baseline: int) -> str:
+    latencies = tracing.Histogram()
+    for report in reports:
+        latencies = latencies.merge(report['latencies'])
+    return (
+        'sent %8.1f/s  recv %8.1f/s  %7.2f MB/s  latency ms p50 %s p90 %s p99 %s  '
+        'rss %.1f MB (%+.1f)  dropped %d  errors %d'
+    ) % (
+        sum(report['sent'] for report in reports) / elapsed,
+        sum(report['received'] for report in reports) / elapsed,
+        sum(report['bytes'] for report in reports) / elapsed / 1e6,
+        *('%.2f' % (value * 1000) if value is not None else '-'
+          for value in (latencies.percentile(p) for p in (50, 90, 99))),
+        memory / 1e6, (memory - baseline) / 1e6,
+        sum(report['dropped'] for report in reports),
+        sum(report['errors'] for report in reports),
+    )
+
+
+def sizes(value: str) -> List[int]:
+    return [int(size) for size in value.split(',')]
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        prog='aiozyre-load', description='Generate load between local aiozyre nodes and report on it')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes')
+    parser.add_argument('--nodes', type=int, default=4, help='Nodes per worker process')
+    parser.add_argument('--rate', type=float, default=10, help='Messages sent per second by each node')
+    parser.add_argument('--shout-ratio', type=float, default=0.5, help='Fraction of messages which are shouts')
+    parser.add_argument('--sizes', type=sizes, default=[64], help='Comma separated payload sizes in bytes')
+    parser.add_argument('--duration', type=float, default=0, help='Seconds to run for, or 0 to run until interrupted')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds between reports')
+    parser.add_argument('--warmup', type=float, default=30, help='Seconds to wait for nodes to discover each other')
+    parser.add_argument('--group', type=str, default='load', help='Group to shout to')
+    parser.add_argument('--base-port', type=int, default=49152, help='First TCP port to use')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    args = parser.parse_args(argv)
+
+    reports = multiprocessing.Queue()
+    stopping = multiprocessing.Event()
+    workers = [
+        multiprocessing.Process(target=work, args=(index, args, reports, stopping), daemon=True)
+        for index in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+
+    # worker index -> report for the current interval, and latest resident set size
+    current = {}
+    memory = {}
+    # All reports so far, merged
+    total = None
+    baseline = None
+    running = len(workers)
+    reported_at = started_at = time.monotonic()
+
+    def collect(index, report):
+        nonlocal running
+        if report is None:
+            running -= 1
+            return
+        current[index] = merge(current[index], report) if index in current else report
+        memory[index] = report['rss']
+
+    try:
+        while running:
+            try:
+                collect(*reports.get(timeout=1))
+            except queue.Empty:
+                if not any(process.is_alive() for process in workers):
+                    break
+                continue
+            if current and len(current) >= running:
+                now = time.monotonic()
+                if baseline is None:
+                    baseline = sum(memory.values())
+                print('%8.1fs  %s' % (now - started_at, summarize(
+                    list(current.values()), now - reported_at, sum(memory.values()), baseline)))
+                sys.stdout.flush()
+                for report in current.values():
+                    total = merge(total, report) if total is not None else report
+                current.clear()
+                reported_at = now
+    except KeyboardInterrupt:
+        stopping.set()
+        for process in workers:
+            process.join()
+        while True:
+            try:
+                collect(*reports.get_nowait())
+            except queue.Empty:
+                break
+    for report in current.values():
+        total = merge(total, report) if total is not None else report
+    for process in workers:
+        process.join()
+    if total is not None:
+        print('   total  %s' % summarize(
+            [total], time.monotonic() - started_at, sum(memory.values()), baseline or sum(memory.values())))
+
+
+if __name__ == '__main__':
+    main()
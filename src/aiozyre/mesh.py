@@ -0,0 +1,388 @@
+import asyncio
+import collections
+import json
+import queue
+import random
+import time
+import uuid
+
+from typing import Iterable
+
+from . import futures
+from . import messages
+from . import nodeconfig
+from . import tracing
+from .exceptions import StartFailed, StopFailed, Stopped
+
+
+class Mesh:
+    """
+    An in-process network of simulated zyre nodes.
+
+    Nodes created with ``Node(..., mesh=mesh)`` discover each other as soon as they start, without
+    beacons, gossip, sockets or threads, and emit the same events as zyre (see util.MSG_SLOTS).
+    Links can be given latency, jitter and loss, and the mesh can be partitioned and healed,
+    which makes it possible to simulate hundreds of nodes deterministically in a single process.
+    """
+
+    def __init__(
+        self, *,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        loss: float = 0.0,
+        seed: int = None
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.random = random.Random(seed)
+        # uuid -> running MeshActor
+        self.actors = {}
+        # frozenset of two node names -> dict of latency_ms, jitter_ms and loss overrides
+        self.overrides = {}
+        # List of sets of node names, or None if the mesh is not partitioned
+        self.partitions = None
+        # (src uuid, dst uuid) -> deque of (deliver_at, msg)
+        self.links = {}
+        # (observer uuid, peer uuid) -> list of asyncio.TimerHandle for EVASIVE/EXIT
+        self.timers = {}
+
+    def actor(self, *, config: nodeconfig.NodeConfig, loop: asyncio.AbstractEventLoop) -> 'MeshActor':
+        """
+        Create an actor attached to this mesh; used by Node in place of NodeActor.
+        """
+        return MeshActor(mesh=self, config=config, loop=loop)
+
+    def configure_link(self, a: str, b: str, *, latency_ms: float = None, jitter_ms: float = None,
+                       loss: float = None):
+        """
+        Override latency, jitter or loss for the link between the nodes named a and b.
+        """
+        overrides = self.overrides.setdefault(frozenset((a, b)), {})
+        for key, value in (('latency_ms', latency_ms), ('jitter_ms', jitter_ms), ('loss', loss)):
+            if value is not None:
+                overrides[key] = value
+
+    def partition(self, *groups: Iterable[str]):
+        """
+        Split the mesh so that nodes can only reach nodes in the same group of names.
+        Nodes not named in any group form one further group together.
+
+        Peers that become unreachable are reported as EVASIVE and then EXIT, according to each
+        node's evasive_timeout_ms and expired_timeout_ms.
+        """
+        self.partitions = [set(group) for group in groups]
+        for observer in list(self.actors.values()):
+            for peer_uuid in list(observer.peers):
+                if not self.reachable(observer, self.actors.get(peer_uuid)):
+                    self.expire(observer, peer_uuid)
+
+    def heal(self):
+        """
+        Remove all partitions; nodes that expired each other will ENTER again.
+        """
+        self.partitions = None
+        for (observer_uuid, peer_uuid), handles in list(self.timers.items()):
+            for handle in handles:
+                handle.cancel()
+            observer = self.actors.get(observer_uuid)
+            if peer_uuid not in self.actors and observer is not None and peer_uuid in observer.peers:
+                # The peer stopped while partitioned, so it will never say goodbye
+                observer.deliver(messages.Msg(event='EXIT', peer=peer_uuid, name=observer.peers[peer_uuid]['name']))
+        self.timers.clear()
+        actors = list(self.actors.values())
+        for i, a in enumerate(actors):
+            for b in actors[i + 1:]:
+                if b.uuid not in a.peers:
+                    self.introduce(b, a)
+                if a.uuid not in b.peers:
+                    self.introduce(a, b)
+
+    def reachable(self, a: 'MeshActor', b: 'MeshActor') -> bool:
+        if a is None or b is None:
+            return False
+        if self.partitions is None:
+            return True
+        return self.partition_of(a.name) == self.partition_of(b.name)
+
+    def partition_of(self, name: str) -> int:
+        for i, group in enumerate(self.partitions):
+            if name in group:
+                return i
+        return -1
+
+    def link_setting(self, a: 'MeshActor', b: 'MeshActor', key: str):
+        overrides = self.overrides.get(frozenset((a.name, b.name)))
+        if overrides and key in overrides:
+            return overrides[key]
+        return getattr(self, key)
+
+    def attach(self, actor: 'MeshActor'):
+        self.actors[actor.uuid] = actor
+        for other in list(self.actors.values()):
+            if other is not actor and self.reachable(actor, other):
+                self.introduce(actor, other)
+                self.introduce(other, actor)
+
+    def detach(self, actor: 'MeshActor'):
+        del self.actors[actor.uuid]
+        for other in list(self.actors.values()):
+            if actor.uuid in other.peers and self.reachable(actor, other):
+                self.send(actor, other, messages.Msg(event='EXIT', peer=actor.uuid, name=actor.name))
+        # Peers that can't reach the actor keep their timers, and will see it EXIT when they expire
+        for key in [key for key in self.timers if key[0] == actor.uuid]:
+            for handle in self.timers.pop(key):
+                handle.cancel()
+
+    def introduce(self, actor: 'MeshActor', observer: 'MeshActor'):
+        """
+        Make actor known to observer, as a zyre HELLO would: ENTER followed by JOIN for each group.
+        """
+        self.send(actor, observer, messages.Msg(
+            event='ENTER', peer=actor.uuid, name=actor.name, headers=json.dumps(actor.config.headers),
+            address=actor.address))
+        for group in sorted(actor.groups):
+            self.send(actor, observer, messages.Msg(event='JOIN', peer=actor.uuid, name=actor.name, group=group))
+
+    def expire(self, observer: 'MeshActor', peer_uuid: str):
+        key = (observer.uuid, peer_uuid)
+        if key in self.timers:
+            return
+        name = observer.peers[peer_uuid]['name']
+        loop = observer.loop
+        self.timers[key] = [
+            loop.call_later(
+                observer.config.evasive_timeout_ms / 1000, observer.deliver,
+                messages.Msg(event='EVASIVE', peer=peer_uuid, name=name)),
+            loop.call_later(
+                observer.config.expired_timeout_ms / 1000, self.expired, observer, peer_uuid, name),
+        ]
+
+    def expired(self, observer: 'MeshActor', peer_uuid: str, name: str):
+        self.timers.pop((observer.uuid, peer_uuid), None)
+        observer.deliver(messages.Msg(event='EXIT', peer=peer_uuid, name=name))
+
+    def send(self, src: 'MeshActor', dst: 'MeshActor', msg: messages.Msg):
+        """
+        Deliver msg from src to dst, honoring the link's latency and loss.
+        Messages on a link are delivered in the order they were sent, as with zyre's TCP links.
+        """
+        if not self.reachable(src, dst):
+            return
+        if msg.event in ('SHOUT', 'WHISPER'):
+            loss = self.link_setting(src, dst, 'loss')
+            if loss and self.random.random() < loss:
+                return
+        delay = self.link_setting(src, dst, 'latency_ms')
+        jitter = self.link_setting(src, dst, 'jitter_ms')
+        if jitter:
+            delay += self.random.uniform(0, jitter)
+        loop = dst.loop
+        key = (src.uuid, dst.uuid)
+        link = self.links.get(key)
+        if link is None:
+            link = self.links[key] = collections.deque()
+        deliver_at = loop.time() + delay / 1000
+        if link and link[-1][0] > deliver_at:
+            deliver_at = link[-1][0]
+        link.append((deliver_at, msg))
+        loop.call_at(deliver_at, self.arrive, key, dst)
+
+    def arrive(self, key: tuple, dst: 'MeshActor'):
+        # Each scheduled call delivers the head of its link, so ties in the timer heap can't reorder messages.
+        link = self.links[key]
+        _, msg = link.popleft()
+        if not link:
+            del self.links[key]
+        dst.deliver(msg)
+
+
+class MeshActor:
+    """
+    Stand-in for NodeActor which exchanges messages through a Mesh instead of a zyre instance.
+
+    All methods run on the event loop thread; give() is thread safe like NodeActor.give().
+    """
+
+    def __init__(
+        self,
+        *,
+        mesh: Mesh,
+        config: nodeconfig.NodeConfig,
+        loop: asyncio.AbstractEventLoop
+    ):
+        self.mesh = mesh
+        self.config = config
+        self.loop = loop
+        self.uuid = None
+        self.started = None
+        self.stopped = None
+        self.running = False
+        self.groups = set()
+        # uuid -> dict of name, headers, address and groups, as learned from ENTER/JOIN/LEAVE events
+        self.peers = {}
+        self.outbox = asyncio.Queue()
+        self.sync_outbox = None
+        self.inbox = queue.Queue()
+
+    @property
+    def name(self) -> str:
+        return self.config.name
+
+    @property
+    def address(self) -> str:
+        return self.config.endpoint or 'inproc://mesh/%s' % self.uuid
+
+    def start(self):
+        if self.started is not None:
+            raise StartFailed('MeshActor already running')
+        self.started = futures.ThreadSafeFuture(loop=self.loop)
+        self.stopped = futures.ThreadSafeFuture(loop=self.loop)
+        self.uuid = uuid.uuid4().hex.upper()
+        self.groups = set(self.config.groups)
+        self.running = True
+        self.mesh.attach(self)
+        self.started.set_result(True)
+
+    def stop(self):
+        if self.started is None:
+            raise StopFailed('MeshActor not running')
+        self.running = False
+        self.mesh.detach(self)
+        self.emit(Stopped())
+        self.stopped.set_result(True)
+
+    def give(self, fut: futures.ThreadSafeFuture):
+        """
+        Give a future for processing on the event loop thread.
+
+        This method is thread safe.
+        """
+        self.inbox.put(fut)
+        self.loop.call_soon_threadsafe(self.process_inbox)
+
+    # There is no zactor thread to signal, so a direct give is the same
+    give_direct = give
+
+    def take(self, timeout: int = None):
+        return self.inbox.get(timeout=timeout)
+
+    def emit(self, msg: messages.Msg):
+        if self.sync_outbox is not None:
+            self.sync_outbox.put(msg)
+        else:
+            self.outbox.put_nowait(msg)
+
+    def deliver(self, msg: messages.Msg):
+        """
+        Apply an incoming event to this actor's view of its peers and emit it.
+        """
+        if not self.running:
+            return
+        event = msg.event
+        if event == 'ENTER':
+            if msg.peer in self.peers:
+                return
+            self.peers[msg.peer] = {
+                'name': msg.name, 'headers': json.loads(msg.headers), 'address': msg.address, 'groups': set()}
+        elif msg.peer not in self.peers:
+            # Events from peers we don't know (e.g. after EXIT) are dropped, as zyre does
+            return
+        elif event == 'JOIN':
+            self.peers[msg.peer]['groups'].add(msg.group)
+        elif event == 'LEAVE':
+            self.peers[msg.peer]['groups'].discard(msg.group)
+        elif event == 'EXIT':
+            self.mesh.timers.pop((self.uuid, msg.peer), None)
+            del self.peers[msg.peer]
+        elif event == 'SHOUT' and msg.group not in self.groups:
+            return
+        if self.config.trace and event in ('SHOUT', 'WHISPER'):
+            msg.trace = {'received_at': time.time()}
+        self.emit(msg)
+
+    def process_inbox(self):
+        """
+        Dequeue an item (future) from the inbox, process it, and set its result.
+        """
+        if not self.running:
+            # As with a destroyed zactor, futures given before stopping are left for the Node to fail
+            return
+        try:
+            fut = self.take(timeout=0)
+        except queue.Empty:
+            return
+        try:
+            fut.set_result(self.process(fut))
+        except Exception as exc:
+            fut.set_exception(exc)
+
+    def drain(self, fut: futures.ThreadSafeFuture):
+        """
+        Process every future in the inbox at once, then set fut's result to the number processed.
+        """
+        count = 0
+        while True:
+            try:
+                item = self.take(timeout=0)
+            except queue.Empty:
+                break
+            try:
+                item.set_result(self.process(item))
+            except Exception as exc:
+                item.set_exception(exc)
+            count += 1
+        fut.set_result(count)
+
+    def process(self, fut: futures.SignalFuture):
+        if not self.running:
+            raise Stopped('MeshActor not running')
+        sig = fut.signal
+        if sig == futures._SHOUT or sig == futures._WHISPER:
+            blob = tracing.stamp(fut.blob, fut.queued_at) if self.config.trace else fut.blob
+        if sig == futures._SHOUT:
+            group = fut.group.decode('utf8')
+            for peer_uuid, peer in self.peers.items():
+                if group in peer['groups']:
+                    self.send(peer_uuid, messages.Msg(
+                        event='SHOUT', peer=self.uuid, name=self.name, group=group, blob=blob))
+        elif sig == futures._WHISPER:
+            self.send(fut.peer.decode('utf8'), messages.Msg(
+                event='WHISPER', peer=self.uuid, name=self.name, blob=blob))
+        elif sig == futures._JOIN or sig == futures._LEAVE:
+            group = fut.group.decode('utf8')
+            joining = sig == futures._JOIN
+            if (group in self.groups) == joining:
+                return None
+            if joining:
+                self.groups.add(group)
+            else:
+                self.groups.discard(group)
+            # Like zyre, tell every connected node, including those whose ENTER hasn't reached us yet
+            for peer_uuid in self.mesh.actors:
+                if peer_uuid == self.uuid:
+                    continue
+                self.send(peer_uuid, messages.Msg(
+                    event='JOIN' if joining else 'LEAVE', peer=self.uuid, name=self.name, group=group))
+        elif sig == futures._PEERS:
+            return set(self.peers)
+        elif sig == futures._PEERS_BY_GROUP:
+            group = fut.group.decode('utf8')
+            return {peer_uuid for peer_uuid, peer in self.peers.items() if group in peer['groups']}
+        elif sig == futures._OWN_GROUPS:
+            return set(self.groups)
+        elif sig == futures._PEER_GROUPS:
+            return set().union(*(peer['groups'] for peer in self.peers.values()))
+        elif sig == futures._PEER_HEADER_VALUE:
+            peer = self.peers.get(fut.peer.decode('utf8'))
+            if peer is None:
+                return None
+            return peer['headers'].get(fut.header.decode('utf8'))
+        else:
+            raise ValueError('Unknown signal')
+        return None
+
+    def send(self, peer_uuid: str, msg: messages.Msg):
+        dst = self.mesh.actors.get(peer_uuid)
+        if dst is not None:
+            self.mesh.send(self, dst, msg)
@@ -1,6 +1,6 @@
 
 class Msg:
-    __slots__ = ('event', 'peer', 'name', 'headers', 'address', 'group', 'blob')
+    __slots__ = ('event', 'peer', 'name', 'headers', 'address', 'group', 'blob', 'trace')
 
     def __init__(
         self,
@@ -11,7 +11,8 @@ class Msg:
         headers: str = None,
         address: str = None,
         group: str = None,
-        blob: bytes = None
+        blob: bytes = None,
+        trace: dict = None
     ):
         self.event = event or ''
         self.peer = peer or ''
@@ -20,9 +21,14 @@ class Msg:
         self.address = address or ''
         self.group = group or ''
         self.blob = blob or b''
+        # Timings of a traced message, see Node(trace=True)
+        self.trace = trace
 
     def __repr__(self):
-        args = ['{}={}'.format(slot, repr(getattr(self, slot))) for slot in self.__slots__]
+        args = [
+            '{}={}'.format(slot, repr(getattr(self, slot)))
+            for slot in self.__slots__ if slot != 'trace' or self.trace is not None
+        ]
         return '{}({})'.format(self.__class__.__name__, ", ".join(args))
 
     @property
@@ -1,19 +1,32 @@
 
 import asyncio
+import collections
+import queue
 import signal
 
-from typing import Union, Mapping, Iterable, Set
+from typing import Callable, Hashable, List, Optional, Union, Mapping, Iterable, Set
 
-from .exceptions import StartFailed, StopFailed
+from .exceptions import StartFailed, StopFailed, Stopped
 
+from . import conflation
+from . import dispatch
+from . import envelopes
 from . import futures
+from . import mesh
 from . import nodeactor
 from . import nodeconfig
 from . import messages
+from . import peerstats
+from . import reliable
+from . import spool
+from . import tracing
 
 
 class Node:
-    __slots__ = ('config', 'loop', 'running', 'startstoplock', 'actor')
+    __slots__ = (
+        'config', 'loop', 'running', 'startstoplock', 'actor', 'mesh', 'dispatcher', 'reliable', 'stats',
+        'filters', 'pending', 'conflate', 'tracer'
+    )
 
     def __init__(
         self,
@@ -22,28 +35,78 @@ class Node:
         groups: Union[None, Iterable[str]] = None,
         endpoint: str = None,
         gossip_endpoint: str = None,
+        gossip_bind: str = None,
+        gossip_connect: Union[None, str, Iterable[str]] = None,
         interface: str = None,
+        port: int = None,
+        beacon_interval_ms: int = None,
         evasive_timeout_ms: int = 5000,
+        silent_timeout_ms: int = None,
         expired_timeout_ms: int = 30000,
         verbose: bool = False,
-        loop: asyncio.AbstractEventLoop = None
+        trace: bool = False,
+        loop: asyncio.AbstractEventLoop = None,
+        mesh: 'mesh.Mesh' = None,
+        ping_interval_ms: int = None,
+        conflate: Callable[[messages.Msg], Optional[Hashable]] = None
     ):
         """
         Constructor, creates a new Zyre node. Note that until you start the
         node it is silent and invisible to other nodes on the network.
         The node name is provided to other nodes during discovery.
+
+        Nodes discover each other with UDP beacons, sent to the given port every
+        beacon_interval_ms, unless gossip is configured: gossip_endpoint both binds
+        and connects, while gossip_bind and gossip_connect (one endpoint or several)
+        bind or connect only, so that a few nodes can serve as hubs for the rest.
+        Using gossip turns beacons off. Peers that have been quiet for
+        silent_timeout_ms, evasive_timeout_ms and expired_timeout_ms are reported as
+        SILENT, EVASIVE and EXIT respectively; silent_timeout_ms requires zyre's draft API,
+        which aiozyre is built against when installed with AIOZYRE_DRAFT_API=1.
+
+        If a Mesh is given, the node runs on that in-process simulated network
+        instead of a zyre instance.
+
+        If ping_interval_ms is given, the node pings its peers at that interval to
+        measure their round trip times and learn their load, see pick_peer().
+
+        If conflate is given, received SHOUT and WHISPER messages are keyed by
+        conflate(msg), e.g. (msg.peer, msg.group, a key parsed from msg.blob), and
+        a message still waiting to be received is replaced in place by a newer one
+        with the same key, so that a consumer which falls behind skips straight to
+        the latest message per key. Messages keyed None are never replaced.
+
+        If trace is true, each SHOUT and WHISPER records how long it spent in the
+        sender's inbox, on the network and in the receiver's outbox, in msg.trace
+        and in per-peer and per-group latency histograms, node.tracer.peers and
+        node.tracer.groups. The receiving node must trace too; set ping_interval_ms
+        on both nodes to correct for the offset between their clocks.
         """
         self.actor = None
+        self.mesh = mesh
         if loop is None:
             loop = asyncio.get_event_loop()
         self.loop = loop
         self.startstoplock = asyncio.Lock()
         self.config = nodeconfig.NodeConfig(
             name=name, headers=headers, groups=groups, endpoint=endpoint, gossip_endpoint=gossip_endpoint,
-            interface=interface, evasive_timeout_ms=evasive_timeout_ms, expired_timeout_ms=expired_timeout_ms,
-            verbose=verbose
+            gossip_bind=gossip_bind, gossip_connect=gossip_connect, interface=interface, port=port,
+            beacon_interval_ms=beacon_interval_ms, evasive_timeout_ms=evasive_timeout_ms,
+            silent_timeout_ms=silent_timeout_ms, expired_timeout_ms=expired_timeout_ms, verbose=verbose,
+            trace=trace
         )
         self.running = False
+        self.dispatcher = dispatch.Dispatcher(self)
+        self.reliable = reliable.ReliableChannel(self)
+        self.stats = peerstats.PeerStats(self, ping_interval_ms=ping_interval_ms)
+        self.tracer = tracing.Tracer(self)
+        # Callables applied in turn to each received message, each returning the list of messages to
+        # pass on; this is where aiozyre's own protocol messages are consumed. Trace envelopes wrap
+        # any other message, so the tracer comes first, and batches from a Spool are split next.
+        self.filters = [self.tracer.filter, spool.unbatch, self.stats.filter, self.reliable.filter]
+        # Messages that have been through the filters but not yet returned by recv()
+        self.pending = collections.deque()
+        self.conflate = conflate
 
     @property
     def name(self):
@@ -68,31 +131,95 @@ class Node:
         async with self.startstoplock:
             if self.running:
                 raise StartFailed('Node already running')
-            self.actor = nodeactor.NodeActor(config=self.config, loop=self.loop)
+            if self.mesh is not None:
+                self.actor = self.mesh.actor(config=self.config, loop=self.loop)
+            else:
+                self.actor = nodeactor.NodeActor(config=self.config, loop=self.loop)
+            if self.conflate is not None:
+                self.actor.outbox = conflation.ConflatingQueue(self.conflation_key)
             self.loop.add_signal_handler(signal.SIGINT, self.stop_sync)
             self.loop.add_signal_handler(signal.SIGABRT, self.stop_sync)
             self.actor.start()
             await self.actor.started
+            self.pending.clear()
+            self.reliable.reset()
             self.running = True
+            self.stats.start()
 
-    async def stop(self):
+    async def stop(self, *, drain: bool = False, timeout: float = 5) -> 'StopReport':
         """
         Stop node; this signals to other peers that this node will go away.
         This is polite; however you can also just destroy the node without
         stopping it.
+
+        New commands are refused with Stopped as soon as stop() is called. If drain is true,
+        commands already given (e.g. by whisper_nowait()) are first handed to zyre in one batch,
+        waiting up to timeout seconds; note that zyre may still lose them if the node goes away
+        before its socket has sent them. Commands left over are failed with Stopped.
+
+        Messages received but not yet read remain readable with recv(), which then raises Stopped,
+        unless drain is true, in which case they are taken and reported instead.
+
+        Returns a StopReport of what was drained and what was dropped, and when draining, of the
+        messages which had been received but not read.
         """
         async with self.startstoplock:
             if not self.running:
                 raise StopFailed('Node not running')
+            self.running = False
+            self.stats.stop()
+            report = StopReport()
+            if drain:
+                fut = futures.ThreadSafeFuture(loop=self.loop)
+                self.actor.drain(fut)
+                done, _ = await asyncio.wait([fut.future], timeout=timeout)
+                if done:
+                    report.drained = fut.result()
+                else:
+                    report.timed_out = True
             self.actor.stop()
             await self.actor.stopped
-            self.running = False
+            while True:
+                try:
+                    fut = self.actor.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if not fut.done():
+                    fut.set_exception(Stopped('Node stopped'))
+                report.dropped.append(fut)
+            if drain:
+                report.unread = self._unread()
+            self.reliable.reset(Stopped('Node stopped'))
             self.loop.remove_signal_handler(signal.SIGINT)
             self.loop.remove_signal_handler(signal.SIGABRT)
+            return report
 
     def stop_sync(self):
         yield from self.stop().__await__()
 
+    def _unread(self) -> List[messages.Msg]:
+        """
+        Take the messages received but not yet read, leaving Stopped for any later recv().
+
+        Includes those queued for a BlockingNode created with receive=True, but not those it has
+        already taken from its queue, e.g. the rest of a batch.
+
+        This method is *not* thread safe and should only be called from the event loop thread,
+        once the actor has stopped.
+        """
+        msgs = list(self.pending)
+        self.pending.clear()
+        for outbox in (self.actor.outbox, self.actor.sync_outbox):
+            if outbox is None:
+                continue
+            while not outbox.empty():
+                msg = outbox.get_nowait()
+                outbox.task_done()
+                if not isinstance(msg, Exception):
+                    msgs.extend(self.filter(msg))
+            outbox.put_nowait(Stopped('Node stopped'))
+        return msgs
+
     async def recv(self, timeout: int = None) -> messages.Msg:
         """
         Receive next message from network; the message may be a control
@@ -104,11 +231,68 @@ class Node:
 
         This method is *not* thread safe and should only be called from the event loop thread.
         """
-        msg = await asyncio.wait_for(asyncio.ensure_future(self.actor.outbox.get()), timeout=timeout)
-        self.actor.outbox.task_done()
-        if isinstance(msg, Exception):
-            raise msg
-        return msg
+        deadline = None if timeout is None else self.loop.time() + timeout
+        while not self.pending:
+            outbox = self.actor.outbox
+            if not outbox.empty():
+                msg = outbox.get_nowait()
+            else:
+                if deadline is not None:
+                    timeout = max(deadline - self.loop.time(), 0)
+                msg = await asyncio.wait_for(asyncio.ensure_future(outbox.get()), timeout=timeout)
+            outbox.task_done()
+            if isinstance(msg, Exception):
+                raise msg
+            self.pending.extend(self.filter(msg))
+        return self.pending.popleft()
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        msgs = [msg]
+        for f in self.filters:
+            msgs = [out for m in msgs for out in f(m)]
+        return msgs
+
+    def conflation_key(self, msg: Union[messages.Msg, Exception]) -> Optional[Hashable]:
+        # Control messages, errors and aiozyre's own protocol messages are never conflated
+        if isinstance(msg, Exception) or msg.event not in ('SHOUT', 'WHISPER'):
+            return None
+        if msg.blob.startswith(envelopes.PREFIX):
+            # Key traced messages by what they wrap
+            blob = tracing.unwrap(msg.blob)
+            if blob is None or blob.startswith(envelopes.PREFIX):
+                return None
+            msg = messages.Msg(event=msg.event, peer=msg.peer, name=msg.name, group=msg.group, blob=blob)
+        return self.conflate(msg)
+
+    def on(self, event: str, group: str = None, handler: Callable = None):
+        """
+        Register a handler to be called by dispatch() for messages of the given event
+        (e.g. 'SHOUT'), optionally restricted to a group. May be used as a decorator.
+        """
+        if handler is None:
+            def decorator(handler):
+                self.dispatcher.register(handler, event, group)
+                return handler
+            return decorator
+        self.dispatcher.register(handler, event, group)
+        return handler
+
+    async def dispatch(self, *, concurrency: int = 16, max_pending: int = 1024):
+        """
+        Receive messages and pass them to the handlers registered with on(), until the node stops.
+
+        Messages from the same peer are handled in order, one at a time; messages from
+        different peers are handled concurrently, up to `concurrency` handlers at once.
+        Messages with no matching handler are discarded.
+
+        Like recv(), this consumes the node's messages, so it should not be combined with other recv() calls.
+        """
+        await self.dispatcher.run(concurrency=concurrency, max_pending=max_pending)
+
+    def give(self, fut: futures.SignalFuture):
+        if not self.running:
+            raise Stopped('Node not running')
+        self.actor.give(fut)
 
     async def shout(self, group: str, blob: Union[bytes, str]):
         """
@@ -117,7 +301,7 @@ class Node:
         if isinstance(blob, str):
             blob = blob.encode('utf8')
         fut = futures.ShoutFuture(group=group, blob=blob, loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         await asyncio.ensure_future(fut)
 
     async def whisper(self, peer: str, blob: Union[bytes, str]):
@@ -127,16 +311,47 @@ class Node:
         if isinstance(blob, str):
             blob = blob.encode('utf8')
         fut = futures.WhisperFuture(peer=peer, blob=blob, loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         await asyncio.ensure_future(fut)
 
+    def whisper_nowait(self, peer: str, blob: Union[bytes, str]) -> futures.WhisperFuture:
+        """
+        Send message to single peer, specified as a UUID string, without waiting
+        for it to be handed to zyre. Messages sent this way keep their order.
+        """
+        if isinstance(blob, str):
+            blob = blob.encode('utf8')
+        fut = futures.WhisperFuture(peer=peer, blob=blob, loop=self.loop)
+        # Often never awaited (e.g. acks and pings), so don't warn about exceptions never retrieved
+        fut.future.add_done_callback(retrieve)
+        self.give(fut)
+        return fut
+
+    async def whisper_reliable(self, peer: str, blob: Union[bytes, str], timeout: float = None):
+        """
+        Send message to single peer, specified as a UUID string, and wait until the peer
+        acknowledges it. Lost messages are retransmitted, and the peer receives messages
+        sent this way in order and without duplicates. Raises Unreachable if the peer exits first,
+        or doesn't acknowledge the message or an earlier one despite retransmissions.
+
+        If timeout expires first, TimeoutError is raised; a message still waiting for room in the
+        window is then never sent, but one already sent keeps being retransmitted, and so may
+        still be delivered.
+
+        Acknowledgements arrive like any other message, so both nodes must be consuming
+        messages with recv() or dispatch().
+        """
+        if isinstance(blob, str):
+            blob = blob.encode('utf8')
+        await asyncio.wait_for(self.reliable.send(peer, blob), timeout=timeout)
+
     async def join(self, group: str):
         """
         Join a named group; after joining a group you can send messages to
         the group and all Zyre nodes in that group will receive them.
         """
         fut = futures.JoinFuture(group=group, loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         await asyncio.ensure_future(fut)
 
     async def leave(self, group: str):
@@ -144,7 +359,7 @@ class Node:
         Leave a named group
         """
         fut = futures.LeaveFuture(group=group, loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         await asyncio.ensure_future(fut)
 
     async def peers(self) -> Set[str]:
@@ -152,7 +367,7 @@ class Node:
         Return set of current peer ids.
         """
         fut = futures.PeersFuture(loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         return await asyncio.ensure_future(fut)
 
     async def peers_by_group(self, group: str) -> Set[str]:
@@ -160,15 +375,29 @@ class Node:
         Return set of current peers of this group.
         """
         fut = futures.PeersByGroupFuture(group=group, loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         return await asyncio.ensure_future(fut)
 
+    async def pick_peer(self, group: str, strategy: str = peerstats.ROUND_ROBIN) -> Optional[str]:
+        """
+        Choose a peer of a group to send a request to, or None if the group has no peers.
+        Evasive peers are avoided. Strategies are:
+
+        'round-robin'    each peer in turn
+        'least-latency'  the peer with the lowest round trip time
+        'least-loaded'   the peer advertising the lowest load
+        'power-of-two'   the less loaded of two peers chosen at random
+
+        Latency and load are measured by pinging peers, see ping_interval_ms.
+        """
+        return self.stats.pick(group, await self.peers_by_group(group), strategy)
+
     async def own_groups(self) -> Set[str]:
         """
         Return set of currently joined groups.
         """
         fut = futures.OwnGroupsFuture(loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         return await asyncio.ensure_future(fut)
 
     async def peer_groups(self) -> Set[str]:
@@ -176,7 +405,7 @@ class Node:
         Return set of groups known through connected peers.
         """
         fut = futures.PeerGroupsFuture(loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         return await asyncio.ensure_future(fut)
 
     async def peer_header_value(self, peer: str, header: str) -> str:
@@ -185,5 +414,32 @@ class Node:
         Returns null if peer or key doesn't exits.
         """
         fut = futures.PeerHeaderValueFuture(peer=peer, header=header, loop=self.loop)
-        self.actor.give(fut)
+        self.give(fut)
         return await asyncio.ensure_future(fut)
+
+
+class StopReport:
+    """
+    What became of a Node's commands and received messages when it was stopped.
+    """
+
+    __slots__ = ('drained', 'timed_out', 'dropped', 'unread')
+
+    def __init__(self):
+        # Number of commands handed to zyre by a draining stop
+        self.drained = 0
+        # Whether draining took longer than the timeout
+        self.timed_out = False
+        # Futures of commands never handed to zyre, failed with Stopped
+        self.dropped = []
+        # Messages received but never returned by recv(), if the stop drained
+        self.unread = []
+
+    def __repr__(self):
+        args = ['{}={}'.format(slot, repr(getattr(self, slot))) for slot in self.__slots__]
+        return '{}({})'.format(self.__class__.__name__, ', '.join(args))
+
+
+def retrieve(fut: asyncio.Future):
+    if not fut.cancelled():
+        fut.exception()
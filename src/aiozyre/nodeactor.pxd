@@ -11,14 +11,24 @@ cdef class NodeActor:
     cpdef public object loop
     cpdef public object inbox
     cpdef public object outbox
+    cpdef public object sync_outbox
 
     # private
     cdef z.zyre_t * zyre
     cdef z.zpoller_t * zpoller
     cdef z.zactor_t * zactor
     cdef z.zsock_t * zactor_pipe
+    cdef z.zsock_t * zpull
+    cdef bytes pull_endpoint
+    cdef object pushers
+    cdef object drain_future
+    cdef bint drained
     cpdef unsigned long zthreadid
     cpdef unsigned long lthreadid
 
 
+cdef class Pusher:
+    cdef z.zsock_t * zsock
+
+
 cdef void node_act(z.zsock_t * pipe, void * _actor) nogil
@@ -5,6 +5,7 @@ import logging
 import queue
 import sys
 import threading
+import time
 
 
 from . import messages
@@ -22,6 +23,7 @@ from libc.string cimport strcmp
 
 from . import futures
 from . import nodeconfig
+from . import tracing
 from . cimport signals
 from . cimport util
 from . cimport zyre as z
@@ -43,6 +45,9 @@ cdef class NodeActor:
         self.zactor = NULL
         self.zpoller = NULL
         self.zyre = NULL
+        self.zpull = NULL
+        self.drain_future = None
+        self.drained = False
         self.zthreadid = -1
         self.lthreadid = threading.get_ident()
         self.started = None
@@ -58,6 +63,15 @@ cdef class NodeActor:
         # it is fine for it to block while waiting for a message.
         self.inbox = queue.Queue()
 
+        # If set, a thread-safe queue.Queue which receives incoming messages in place of outbox,
+        # straight from the zactor thread.
+        self.sync_outbox = None
+
+        # Threads other than the loop thread signal the zactor thread through their own PUSH socket
+        # (zmq sockets aren't thread safe), connected to a PULL socket which the zactor polls.
+        self.pull_endpoint = ('inproc://aiozyre-nodeactor-%x' % id(self)).encode('utf8')
+        self.pushers = threading.local()
+
     def __init__(
         self,
         *,
@@ -73,6 +87,8 @@ cdef class NodeActor:
             logger.warning('NodeActor.zyre could not be deallocated')
         if self.zactor_pipe is not NULL:
             logger.warning('NodeActor.zactor_pipe could not be deallocated')
+        if self.zpull is not NULL:
+            logger.warning('NodeActor.zpull could not be deallocated')
         if self.zactor is not NULL:
             logger.warning('NodeActor.zactor could not be deallocated')
 
@@ -138,6 +154,20 @@ cdef class NodeActor:
         self.inbox.put(fut)
         self.loop.call_soon_threadsafe(self.signal_incoming)
 
+    def give_direct(self, fut):
+        """
+        Give a future for processing by the zactor thread, signalling the zactor thread
+        directly from the calling thread rather than by way of the event loop.
+
+        This method is thread safe.
+        """
+        self.inbox.put(fut)
+        pusher = getattr(self.pushers, 'pusher', None)
+        if pusher is None:
+            pusher = self.pushers.pusher = Pusher(self.pull_endpoint)
+        if pusher.send() != 0:
+            raise Stopped('NodeActor not running')
+
     def take(self, timeout: int = None) -> messages.Msg:
         """
         Receive a future for processing by the zactor thread.
@@ -152,7 +182,10 @@ cdef class NodeActor:
 
         This method is thread safe.
         """
-        self.loop.call_soon_threadsafe(self.outbox.put_nowait, msg)
+        if self.sync_outbox is not None:
+            self.sync_outbox.put(msg)
+        else:
+            self.loop.call_soon_threadsafe(self.outbox.put_nowait, msg)
 
     def signal_incoming(self):
         """
@@ -161,10 +194,26 @@ cdef class NodeActor:
         This method is *not* thread safe and should only be called from the event loop thread.
         """
         self.assert_lthread()
+        if self.zactor is NULL:
+            # Stopped since the future was given; NodeActor's owner fails leftover futures
+            return
         with nogil:
             # notify zactor's poller to check inbox
             z.zstr_send(self.zactor, signals.INCOMING)
 
+    def drain(self, fut: futures.ThreadSafeFuture):
+        """
+        Have the zactor thread process every future in the inbox at once, without waiting for
+        their signals, then set fut's result to the number processed.
+
+        This method is *not* thread safe and should only be called from the event loop thread.
+        """
+        self.assert_lthread()
+        self.drain_future = fut
+        with nogil:
+            # Signals for the inbox's futures may still be waiting on the event loop; this one goes first
+            z.zstr_send(self.zactor, signals.DRAIN)
+
     def configure(object self):
         """
         Configure and start the zyre node for this zactor.
@@ -173,6 +222,10 @@ cdef class NodeActor:
         """
 
         self.assert_zthread()
+        if self.config.silent_timeout_ms is not None and not z.DRAFT_API:
+            raise StartFailed(
+                "silent_timeout_ms requires zyre's draft API; rebuild aiozyre with AIOZYRE_DRAFT_API=1")
+
         name = self.config.name.encode('utf8')
         self.zyre = z.zyre_new(name)
         if self.zyre is NULL:
@@ -198,17 +251,35 @@ cdef class NodeActor:
             endpoint = <char*>endpoint
             z.zyre_set_endpoint(self.zyre, "%s", endpoint)
 
-        if self.config.gossip_endpoint:
-            gossip_endpoint = self.config.gossip_endpoint.encode('utf8')
-            gossip_endpoint = <char*>gossip_endpoint
-            z.zyre_gossip_connect(self.zyre, "%s", gossip_endpoint)
-            z.zyre_gossip_bind(self.zyre, "%s", gossip_endpoint)
+        if self.config.port is not None:
+            z.zyre_set_port(self.zyre, self.config.port)
+
+        if self.config.beacon_interval_ms is not None:
+            z.zyre_set_interval(self.zyre, self.config.beacon_interval_ms)
+
+        # Using gossip turns off UDP beacon discovery
+        gossip_bind, gossip_connect = self.config.gossip()
+
+        for endpoint in gossip_connect:
+            endpoint = endpoint.encode('utf8')
+            endpoint = <char*>endpoint
+            z.zyre_gossip_connect(self.zyre, "%s", endpoint)
+
+        if gossip_bind:
+            endpoint = gossip_bind.encode('utf8')
+            endpoint = <char*>endpoint
+            z.zyre_gossip_bind(self.zyre, "%s", endpoint)
+
+        if gossip_connect or gossip_bind:
             # Give some time for the bind/connect to occur
             z.zclock_sleep(250)
 
         if self.config.evasive_timeout_ms is not None:
             z.zyre_set_evasive_timeout(self.zyre, self.config.evasive_timeout_ms)
 
+        if self.config.silent_timeout_ms is not None:
+            z.zyre_set_silent_timeout(self.zyre, self.config.silent_timeout_ms)
+
         if self.config.expired_timeout_ms is not None:
             z.zyre_set_expired_timeout(self.zyre, self.config.expired_timeout_ms)
 
@@ -226,6 +297,14 @@ cdef class NodeActor:
 
         z.zpoller_add(self.zpoller, z.zyre_socket(self.zyre))
 
+        endpoint = b'@' + self.pull_endpoint
+        self.zpull = z.zsock_new_pull(endpoint)
+        if self.zpull is NULL:
+            z.zpoller_destroy(&self.zpoller)
+            z.zyre_destroy(&self.zyre)
+            raise MemoryError('Could not create zsock instance')
+        z.zpoller_add(self.zpoller, self.zpull)
+
         for g in self.config.groups:
             group = g.encode('utf8')
             group = <char*>group
@@ -254,7 +333,10 @@ cdef class NodeActor:
                         terminated = 1
                     else:
                         with gil:
+                            received_at = time.time() if self.config.trace else None
                             msg = util.zmsg_to_msg(zmsg)
+                            if received_at is not None and msg.event in ('SHOUT', 'WHISPER'):
+                                msg.trace = {'received_at': received_at}
                             self.emit(msg)
                 elif which is self.zactor_pipe:
                     cmd = z.zstr_recv(which)
@@ -263,10 +345,18 @@ cdef class NodeActor:
                     elif strcmp(cmd, signals.INCOMING) == 0:
                         with gil:
                             self.process_inbox()
+                    elif strcmp(cmd, signals.DRAIN) == 0:
+                        with gil:
+                            self.process_drain()
                     else:
                         with gil:
                             logger.error('node_actor_loop: received unknown cmd %s' % (<bytes>cmd).decode('utf8'))
                     free(cmd)
+                elif which is self.zpull:
+                    cmd = z.zstr_recv(which)
+                    free(cmd)
+                    with gil:
+                        self.process_inbox()
                 if z.zpoller_terminated(self.zpoller):
                     terminated = 1
 
@@ -277,6 +367,44 @@ cdef class NodeActor:
         This method is *not* thread safe and should only be called from the zactor thread.
         """
         self.assert_zthread()
+        try:
+            # Once drained, signals may arrive for futures that have already been processed
+            fut = self.take(timeout=0 if self.drained else 5)
+        except queue.Empty:
+            if not self.drained:
+                logger.warning('Received signal but no message in inbox')
+            return
+        self.process(fut)
+
+    def process_drain(self):
+        """
+        Process every future in the inbox, and set the drain future's result to how many there were.
+
+        This method is *not* thread safe and should only be called from the zactor thread.
+        """
+        self.assert_zthread()
+        self.drained = True
+        count = 0
+        while True:
+            try:
+                fut = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self.process(fut)
+            except Exception as exc:
+                logger.exception(exc)
+            count += 1
+        fut, self.drain_future = self.drain_future, None
+        if fut is not None:
+            fut.set_result(count)
+
+    def process(self, fut):
+        """
+        Carry out a future's command with zyre, and set its result.
+
+        This method is *not* thread safe and should only be called from the zactor thread.
+        """
         cdef:
             char * group
             char * peer
@@ -287,24 +415,20 @@ cdef class NodeActor:
             z.zlist_t * zlist
             int sig
 
-        try:
-            fut = self.take(timeout=5)
-        except TimeoutError:
-            logger.warning('Received signal but no message in inbox')
-            return
-
         Py_INCREF(fut)
         try:
             sig = fut.signal
             if sig == signals.SHOUT:
                 group = fut.group
-                blob = fut.blob
+                data = tracing.stamp(fut.blob, fut.queued_at) if self.config.trace else fut.blob
+                blob = data
                 with nogil:
                     z.zyre_shouts(self.zyre, group, "%s", blob)
                 fut.set_result(None)
             elif sig == signals.WHISPER:
                 peer = fut.peer
-                blob = fut.blob
+                data = tracing.stamp(fut.blob, fut.queued_at) if self.config.trace else fut.blob
+                blob = data
                 with nogil:
                     z.zyre_whispers(self.zyre, peer, "%s", blob)
                 fut.set_result(None)
@@ -405,6 +529,9 @@ cdef class NodeActor:
                     z.zpoller_destroy(&self.zpoller)
                     self.zpoller = NULL
                     self.zactor_pipe = NULL
+                if self.zpull is not NULL:
+                    z.zsock_destroy(&self.zpull)
+                    self.zpull = NULL
                 if self.zyre is not NULL:
                     z.zyre_stop(self.zyre)
                     z.zclock_sleep(500)
@@ -418,6 +545,32 @@ cdef class NodeActor:
                 self.stopped.set_result(True)
 
 
+cdef class Pusher:
+    """
+    PUSH socket connected to a NodeActor's PULL socket, for signalling its zactor thread from one other thread.
+    """
+
+    def __cinit__(self, bytes endpoint):
+        endpoint = b'>' + endpoint
+        self.zsock = z.zsock_new_push(endpoint)
+        if self.zsock is NULL:
+            raise MemoryError('Could not create zsock instance')
+        # Senders block while the zactor thread is SNDHWM signals behind, which throttles them,
+        # but give up after a while if it has gone away
+        z.zsock_set_sndtimeo(self.zsock, 5000)
+
+    def __dealloc__(self):
+        if self.zsock is not NULL:
+            z.zsock_destroy(&self.zsock)
+            self.zsock = NULL
+
+    def send(self) -> int:
+        cdef int rc
+        with nogil:
+            rc = z.zstr_send(self.zsock, signals.INCOMING)
+        return rc
+
+
 cdef void node_act(z.zsock_t * pipe, void * _self) nogil:
     """
     Long running function that handles inputs and outputs from zyre <-> Node.
@@ -1,5 +1,5 @@
 
-from typing import Mapping, Union, Iterable
+from typing import Mapping, Union, Iterable, List, Optional, Tuple
 
 
 class NodeConfig:
@@ -10,17 +10,43 @@ class NodeConfig:
         groups: Union[None, Iterable[str]] = None,
         endpoint: str = None,
         gossip_endpoint: str = None,
+        gossip_bind: str = None,
+        gossip_connect: Union[None, str, Iterable[str]] = None,
         interface: str = None,
+        port: int = None,
+        beacon_interval_ms: int = None,
         evasive_timeout_ms: int = 5000,
+        silent_timeout_ms: int = None,
         expired_timeout_ms: int = 30000,
-        verbose: bool = False
+        verbose: bool = False,
+        trace: bool = False
     ):
         self.name = name
         self.headers = headers or {}
         self.groups = groups or set()
         self.endpoint = endpoint
         self.gossip_endpoint = gossip_endpoint
+        self.gossip_bind = gossip_bind
+        if isinstance(gossip_connect, str):
+            gossip_connect = [gossip_connect]
+        self.gossip_connect = list(gossip_connect or [])
         self.interface = interface
+        self.port = port
+        self.beacon_interval_ms = beacon_interval_ms
         self.evasive_timeout_ms = evasive_timeout_ms
+        self.silent_timeout_ms = silent_timeout_ms
         self.expired_timeout_ms = expired_timeout_ms
         self.verbose = int(verbose)
+        self.trace = trace
+
+    def gossip(self) -> Tuple[Optional[str], List[str]]:
+        """
+        Return the gossip endpoint to bind, if any, and the gossip endpoints to connect to.
+        gossip_endpoint is connected to, and bound unless gossip_bind is given.
+        """
+        bind = self.gossip_bind
+        connect = list(self.gossip_connect)
+        if self.gossip_endpoint:
+            connect.append(self.gossip_endpoint)
+            bind = bind or self.gossip_endpoint
+        return bind, connect
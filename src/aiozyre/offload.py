@@ -0,0 +1,93 @@
+import asyncio
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Hashable
+
+from . import messages
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Not available before Python 3.8; blobs are always pickled
+    shared_memory = None
+
+
+class ProcessStage:
+    """
+    Runs a CPU-bound function over message blobs in a pool of worker processes.
+
+    Blobs with the same key (by default, the sending peer) always go to the same worker process,
+    which handles them one at a time, so results for a key come back in submission order.
+    Blobs of at least shm_threshold bytes are handed to workers through shared memory
+    rather than being pickled through the pool's pipe.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[bytes], Any], *,
+        workers: int = None,
+        key: Callable[[messages.Msg], Hashable] = None,
+        shm_threshold: int = 64 * 1024,
+        mp_context=None
+    ):
+        self.func = func
+        self.key = key or (lambda msg: msg.peer)
+        self.shm_threshold = shm_threshold if shared_memory is not None else None
+        kwargs = {'mp_context': mp_context} if mp_context is not None else {}
+        if self.shm_threshold is not None:
+            # Start the tracker before any worker exists so that workers share it, rather than each
+            # starting their own, which would report the parent's segments as leaked
+            resource_tracker.ensure_running()
+        # One single-process pool per worker gives each key a FIFO lane
+        self.executors = [ProcessPoolExecutor(max_workers=1, **kwargs) for _ in range(workers or os.cpu_count() or 1)]
+
+    async def submit(self, blob: bytes, key: Hashable = None) -> Any:
+        """
+        Return func(blob), computed in the worker process that handles key.
+        """
+        executor = self.executors[hash(key) % len(self.executors)]
+        if self.shm_threshold is None or len(blob) < max(self.shm_threshold, 1):
+            return await asyncio.wrap_future(executor.submit(self.func, blob))
+        shm = shared_memory.SharedMemory(create=True, size=len(blob))
+        try:
+            shm.buf[:len(blob)] = blob
+            return await asyncio.wrap_future(executor.submit(_call_shm, self.func, shm.name, len(blob)))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    async def process(self, msg: messages.Msg) -> Any:
+        """
+        Return func(msg.blob), computed in the worker process that handles the message's key.
+        """
+        return await self.submit(msg.blob, self.key(msg))
+
+    def handler(self, callback: Callable[[messages.Msg, Any], Any]) -> Callable:
+        """
+        Wrap callback(msg, result) as a handler for Node.on(), computing result in the pool.
+        """
+        async def handle(msg):
+            result = callback(msg, await self.process(msg))
+            if asyncio.iscoroutine(result):
+                await result
+        return handle
+
+    def close(self, wait: bool = True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _call_shm(func: Callable[[bytes], Any], name: str, size: int) -> Any:
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        blob = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return func(blob)
@@ -0,0 +1,163 @@
+import asyncio
+import random
+import time
+
+from typing import Dict, Iterable, List, Optional
+
+from . import envelopes
+from . import messages
+from .exceptions import Stopped
+
+
+ROUND_ROBIN = 'round-robin'
+LEAST_LATENCY = 'least-latency'
+LEAST_LOADED = 'least-loaded'
+POWER_OF_TWO = 'power-of-two'
+
+STRATEGIES = (ROUND_ROBIN, LEAST_LATENCY, LEAST_LOADED, POWER_OF_TWO)
+
+
+class PeerStats:
+    """
+    Per-peer round trip time and load, for choosing which peer of a group to send a request to.
+
+    Round trip times are smoothed over pings (sent every ping_interval_ms, if set) and reliable
+    whisper acknowledgements. Pings and their replies carry each node's advertised `load`, which
+    applications set to whatever figure suits them, e.g. the number of requests in progress.
+    Peers reported EVASIVE are avoided until they are heard from again.
+
+    Pings also estimate the offset of each peer's wall clock from ours, NTP-style, assuming
+    that pings and their replies take as long as each other on the network; see Node(trace=True).
+    """
+
+    def __init__(self, node, *, ping_interval_ms: int = None):
+        self.node = node
+        self.ping_interval_ms = ping_interval_ms
+        self.load = 0.0
+        # peer -> smoothed round trip time, in seconds
+        self.rtts = {}
+        # peer -> load last advertised by the peer
+        self.loads = {}
+        # peer -> smoothed offset of the peer's wall clock from ours, in seconds
+        self.offsets = {}
+        self.evasive = set()
+        # group -> round robin position
+        self.positions = {}
+        self.random = random.Random()
+        self.task = None
+
+    def get(self, peer: str) -> Dict:
+        """
+        Return what is known about peer: its round trip time in seconds, its load, and whether it is evasive.
+        """
+        return {'rtt': self.rtts.get(peer), 'load': self.loads.get(peer), 'evasive': peer in self.evasive}
+
+    def observe(self, peer: str, rtt: float):
+        srtt = self.rtts.get(peer)
+        self.rtts[peer] = rtt if srtt is None else 0.875 * srtt + 0.125 * rtt
+
+    def observe_offset(self, peer: str, offset: float):
+        smoothed = self.offsets.get(peer)
+        self.offsets[peer] = offset if smoothed is None else 0.875 * smoothed + 0.125 * offset
+
+    def arrival(self, msg: messages.Msg) -> float:
+        # Traced messages know when they arrived, before waiting in the outbox
+        if msg.trace is not None:
+            return msg.trace['received_at']
+        return time.time()
+
+    def ping(self, peer: str):
+        if self.node.running:
+            self.node.whisper_nowait(
+                peer, envelopes.pack(envelopes.PING, time.monotonic(), self.load, '%.6f' % time.time()))
+
+    def start(self):
+        if self.ping_interval_ms:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.rtts.clear()
+        self.loads.clear()
+        self.offsets.clear()
+        self.evasive.clear()
+        self.positions.clear()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.ping_interval_ms / 1000)
+            try:
+                peers = await self.node.peers()
+            except Stopped:
+                break
+            for peer in peers:
+                self.ping(peer)
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        """
+        Track peer liveness, and answer and consume pings among received messages.
+        """
+        if msg.event == 'EVASIVE':
+            self.evasive.add(msg.peer)
+            return [msg]
+        self.evasive.discard(msg.peer)
+        if msg.event == 'EXIT':
+            self.rtts.pop(msg.peer, None)
+            self.loads.pop(msg.peer, None)
+            self.offsets.pop(msg.peer, None)
+            return [msg]
+        if msg.event != 'WHISPER':
+            return [msg]
+        envelope = envelopes.unpack(msg.blob)
+        if envelope is None:
+            return [msg]
+        kind, fields, payload = envelope
+        if kind == envelopes.PING:
+            self.loads[msg.peer] = float(fields[1])
+            if self.node.running:
+                reply = [fields[0], self.load]
+                if len(fields) >= 3:
+                    # For the clock offset, echo the ping's wall clock time along with ours when it
+                    # arrived and now
+                    reply += [fields[2], '%.6f' % self.arrival(msg), '%.6f' % time.time()]
+                self.node.whisper_nowait(msg.peer, envelopes.pack(envelopes.PONG, *reply))
+            return []
+        elif kind == envelopes.PONG:
+            self.observe(msg.peer, time.monotonic() - float(fields[0]))
+            self.loads[msg.peer] = float(fields[1])
+            if len(fields) >= 5:
+                t0, t1, t2 = float(fields[2]), float(fields[3]), float(fields[4])
+                self.observe_offset(msg.peer, ((t1 - t0) + (t2 - self.arrival(msg))) / 2)
+            return []
+        return [msg]
+
+    def pick(self, group: str, peers: Iterable[str], strategy: str = ROUND_ROBIN) -> Optional[str]:
+        """
+        Choose one of peers, or None if there are none. Evasive peers are only chosen if all peers are evasive.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown strategy %r' % strategy)
+        peers = sorted(peers)
+        candidates = [peer for peer in peers if peer not in self.evasive] or peers
+        if not candidates:
+            return None
+        if strategy == ROUND_ROBIN:
+            position = self.positions.get(group, 0)
+            self.positions[group] = position + 1
+            return candidates[position % len(candidates)]
+        if strategy == POWER_OF_TWO and len(candidates) > 2:
+            candidates = self.random.sample(candidates, 2)
+        else:
+            # Break ties randomly, so that peers with no measurements yet share the load
+            self.random.shuffle(candidates)
+        if strategy == LEAST_LATENCY:
+            return min(candidates, key=self.latency_key)
+        return min(candidates, key=self.load_key)
+
+    def latency_key(self, peer: str):
+        return self.rtts.get(peer, float('inf'))
+
+    def load_key(self, peer: str):
+        return self.loads.get(peer, float('inf')), self.rtts.get(peer, float('inf'))
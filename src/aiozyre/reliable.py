@@ -0,0 +1,307 @@
+import asyncio
+import collections
+import random
+import time
+
+from typing import List
+
+from . import envelopes
+from . import messages
+from .exceptions import Stopped, Unreachable
+
+
+class ReliableChannel:
+    """
+    Acknowledged, ordered whispers on top of a Node.
+
+    Each message carries a per-peer sequence number. Up to `window` messages per peer may be
+    unacknowledged at once. Receivers buffer messages that arrive out of order, drop duplicates, and
+    acknowledge cumulatively along with a bitmask of the buffered messages, so that senders can
+    resend just the missing ones as soon as later ones are acknowledged. Other unacknowledged messages
+    are retransmitted when their retransmission timeout (estimated from round trip times, between
+    min_timeout_ms and max_timeout_ms) expires. Once a message has been retransmitted
+    max_retransmits times without being acknowledged, every pending send to the peer fails with
+    Unreachable.
+
+    Every message to a peer is tagged with an epoch, so that a receiver can tell a restarted sender,
+    or one which gave up on it, from a retransmission and start over at its first sequence number.
+
+    Frames and acknowledgements are handled as messages are received, so both nodes must be
+    consuming messages with Node.recv() or Node.dispatch().
+    """
+
+    def __init__(
+        self,
+        node, *,
+        window: int = 64,
+        min_timeout_ms: int = 200,
+        max_timeout_ms: int = 5000,
+        max_retransmits: int = 10
+    ):
+        self.node = node
+        self.window = window
+        self.min_timeout_ms = min_timeout_ms
+        self.max_timeout_ms = max_timeout_ms
+        self.max_retransmits = max_retransmits
+        # Latest epoch handed out
+        self.epoch = None
+        # peer -> _Sender
+        self.senders = {}
+        # peer -> _Receiver
+        self.receivers = {}
+        # peers to which a cumulative ack will be sent on the next loop iteration
+        self.acks = set()
+
+    def reset(self, exc: Exception = None):
+        """
+        Forget all peers, failing unacknowledged sends with exc.
+        """
+        self.new_epoch()
+        for sender in self.senders.values():
+            sender.close(exc or Stopped('Node stopped'))
+        self.senders.clear()
+        self.receivers.clear()
+        self.acks.clear()
+
+    def new_epoch(self) -> int:
+        # Epochs increase across restarts, so receivers can ignore stragglers from an earlier epoch
+        self.epoch = max(int(time.time() * 1000) * 1000 + random.randrange(1000), (self.epoch or 0) + 1)
+        return self.epoch
+
+    def send(self, peer: str, blob: bytes) -> asyncio.Future:
+        """
+        Queue blob for reliable delivery to peer; the returned future resolves once peer acknowledges it.
+        """
+        if self.epoch is None:
+            self.reset()
+        sender = self.senders.get(peer)
+        if sender is None:
+            sender = self.senders[peer] = _Sender(self, peer)
+        fut = self.node.loop.create_future()
+        sender.send(blob, fut)
+        return fut
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        """
+        Handle reliable channel frames among received messages, returning the messages to deliver.
+        """
+        if msg.event == 'EXIT':
+            sender = self.senders.pop(msg.peer, None)
+            if sender is not None:
+                sender.close(Unreachable('Peer %s exited' % msg.peer))
+            self.receivers.pop(msg.peer, None)
+            return [msg]
+        if msg.event != 'WHISPER':
+            return [msg]
+        envelope = envelopes.unpack(msg.blob)
+        if envelope is None:
+            return [msg]
+        kind, fields, payload = envelope
+        if kind == envelopes.RELIABLE_DATA:
+            epoch, seq = int(fields[0]), int(fields[1])
+            receiver = self.receivers.get(msg.peer)
+            if receiver is None or epoch > receiver.epoch:
+                receiver = self.receivers[msg.peer] = _Receiver(epoch)
+            elif epoch < receiver.epoch:
+                return []
+            # Echoing the latest frame's send time lets the sender measure round trips even across retransmissions
+            receiver.echo = fields[2]
+            self.ack(msg.peer)
+            return [
+                messages.Msg(event='WHISPER', peer=msg.peer, name=msg.name, blob=blob, trace=msg.trace)
+                for blob in receiver.receive(seq, payload, self.window * 4)
+            ]
+        elif kind == envelopes.RELIABLE_ACK:
+            sender = self.senders.get(msg.peer)
+            if sender is not None and int(fields[0]) == sender.epoch:
+                sender.acked(int(fields[1]), int(fields[2], 16), float(fields[3]))
+            return []
+        return [msg]
+
+    def ack(self, peer: str):
+        if not self.acks:
+            self.node.loop.call_soon(self.flush_acks)
+        self.acks.add(peer)
+
+    def flush_acks(self):
+        # One ack per peer for everything received in this loop iteration
+        for peer in self.acks:
+            receiver = self.receivers.get(peer)
+            if receiver is not None:
+                self.transmit(peer, envelopes.pack(
+                    envelopes.RELIABLE_ACK, receiver.epoch, receiver.expected - 1, '%x' % receiver.sacks(),
+                    receiver.echo))
+        self.acks.clear()
+
+    def transmit(self, peer: str, blob: bytes):
+        if self.node.running:
+            self.node.whisper_nowait(peer, blob)
+
+
+class _Sender:
+    def __init__(self, channel: ReliableChannel, peer: str):
+        self.channel = channel
+        self.peer = peer
+        self.epoch = channel.new_epoch()
+        self.next_seq = 1
+        # seq -> [blob, future, sent_at, selectively acked, times sent]
+        self.unacked = collections.OrderedDict()
+        # (blob, future) waiting for room in the window
+        self.waiting = collections.deque()
+        self.timer = None
+        self.srtt = None
+        self.rttvar = None
+        self.rto = channel.min_timeout_ms / 1000
+
+    def send(self, blob: bytes, fut: asyncio.Future):
+        if len(self.unacked) < self.channel.window:
+            self.transmit(blob, fut)
+        else:
+            self.waiting.append((blob, fut))
+
+    def transmit(self, blob: bytes, fut: asyncio.Future):
+        seq = self.next_seq
+        self.next_seq += 1
+        entry = self.unacked[seq] = [blob, fut, None, False, 0]
+        self.retransmit(seq, entry, time.monotonic())
+        if self.timer is None:
+            self.schedule()
+
+    def retransmit(self, seq: int, entry: list, now: float):
+        entry[2] = now
+        entry[4] += 1
+        self.channel.transmit(self.peer, envelopes.pack(
+            envelopes.RELIABLE_DATA, self.epoch, seq, '%.6f' % now, payload=entry[0]))
+
+    def acked(self, ack: int, sacks: int, echo: float):
+        """
+        Handle an acknowledgement of every seq up to ack, and of each seq ack + 2 + i for bit i set in sacks.
+        echo is the send time of the frame which prompted the acknowledgement.
+        """
+        now = time.monotonic()
+        while self.unacked:
+            seq = next(iter(self.unacked))
+            if seq > ack:
+                break
+            fut = self.unacked.pop(seq)[1]
+            if not fut.done():
+                fut.set_result(None)
+        self.observe(now - echo)
+        highest = 0
+        while sacks:
+            bit = sacks & -sacks
+            highest = ack + 1 + bit.bit_length()
+            entry = self.unacked.get(highest)
+            if entry is not None:
+                entry[3] = True
+            sacks ^= bit
+        # Fast retransmit: a seq that is still missing while later ones have arrived was probably lost,
+        # so resend it without waiting for the timeout, but at most once per round trip
+        if highest:
+            for seq, entry in self.unacked.items():
+                if seq > highest:
+                    break
+                if not entry[3] and now - entry[2] >= self.srtt and entry[4] <= self.channel.max_retransmits:
+                    self.retransmit(seq, entry, now)
+        while self.waiting and len(self.unacked) < self.channel.window:
+            blob, fut = self.waiting.popleft()
+            # Sends which timed out or were cancelled before their turn are never transmitted
+            if not fut.done():
+                self.transmit(blob, fut)
+        self.schedule()
+
+    def observe(self, rtt: float):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.channel.min_timeout_ms / 1000),
+                       self.channel.max_timeout_ms / 1000)
+        self.channel.node.stats.observe(self.peer, rtt)
+
+    def schedule(self):
+        """
+        Set the retransmission timer for the oldest unacknowledged seq.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        oldest = min((entry[2] for entry in self.unacked.values() if not entry[3]), default=None)
+        if oldest is not None:
+            self.timer = self.channel.node.loop.call_later(
+                max(oldest + self.rto - time.monotonic(), 0), self.expire)
+
+    def expire(self):
+        self.timer = None
+        now = time.monotonic()
+        expired = False
+        for seq, entry in self.unacked.items():
+            # Timers may fire up to a clock tick early
+            if not entry[3] and now - entry[2] >= self.rto - 0.001:
+                if entry[4] > self.channel.max_retransmits:
+                    self.give_up()
+                    return
+                expired = True
+                self.retransmit(seq, entry, now)
+        if expired:
+            self.rto = min(self.rto * 2, self.channel.max_timeout_ms / 1000)
+        self.schedule()
+
+    def give_up(self):
+        """
+        Fail every pending send to the peer; the next send starts over with a new epoch.
+        """
+        if self.channel.senders.get(self.peer) is self:
+            del self.channel.senders[self.peer]
+        self.close(Unreachable('Peer %s did not acknowledge after %d retransmissions' % (
+            self.peer, self.channel.max_retransmits)))
+
+    def close(self, exc: Exception):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for entry in self.unacked.values():
+            if not entry[1].done():
+                entry[1].set_exception(exc)
+        for blob, fut in self.waiting:
+            if not fut.done():
+                fut.set_exception(exc)
+        self.unacked.clear()
+        self.waiting.clear()
+
+
+class _Receiver:
+    def __init__(self, epoch: int):
+        self.epoch = epoch
+        self.expected = 1
+        # Send time of the latest frame, echoed in acknowledgements
+        self.echo = None
+        # seq -> payload received ahead of self.expected
+        self.buffer = {}
+
+    def receive(self, seq: int, payload: bytes, limit: int) -> List[bytes]:
+        if seq < self.expected or seq in self.buffer:
+            # duplicate
+            return []
+        if seq > self.expected:
+            if seq - self.expected <= limit:
+                self.buffer[seq] = payload
+            return []
+        delivered = [payload]
+        self.expected += 1
+        while self.expected in self.buffer:
+            delivered.append(self.buffer.pop(self.expected))
+            self.expected += 1
+        return delivered
+
+    def sacks(self) -> int:
+        """
+        Bitmask of the buffered seqs; bit i stands for seq self.expected + 1 + i.
+        """
+        mask = 0
+        for seq in self.buffer:
+            mask |= 1 << (seq - self.expected - 1)
+        return mask
@@ -1,4 +1,5 @@
 # cython: language_level=3
 
 cdef const char * TERMINATE = "$TERM"
-cdef const char * INCOMING = "I"
\ No newline at end of file
+cdef const char * INCOMING = "I"
+cdef const char * DRAIN = "D"
\ No newline at end of file
@@ -0,0 +1,303 @@
+import collections
+import mmap
+import tempfile
+import time
+
+from typing import List, Optional, Union
+
+from . import envelopes
+from . import messages
+
+
+class Spool:
+    """
+    Outbound store-and-forward spool for whispers to peers that are temporarily gone.
+
+    Whispers sent with Spool.whisper() to a connected peer are sent at once, even if it is
+    EVASIVE: zyre still accepts whispers for it, and a quiet peer (e.g. in a gossip-only cluster,
+    where idle peers send no beacons) may be evasive for long stretches without ever being
+    announced as back. A copy of each whisper sent to an evasive peer is kept until the peer is
+    heard from, or for the node's expired_timeout_ms, after which it would have EXITed if it were
+    gone; if it EXITs, the copies are held again. Whispers to a peer which has EXITed or hasn't
+    been seen yet are held and flushed, in order and batched into as few whispers as possible,
+    when the peer ENTERs again. Peers may be given by uuid or by name; since a restarted node has
+    a new uuid, whispers held for a uuid are flushed to whichever node next ENTERs with its name.
+
+    Held whispers are kept in memory up to max_memory_bytes, then in a memory-mapped segment
+    file of max_disk_bytes in directory (the system's temporary directory by default). The
+    file only extends memory: it is deleted when the spool is closed and isn't replayed by a
+    later process. Whispers are dropped, oldest first, once held for longer than max_age_ms or
+    when there is no room for newer ones; `dropped` counts them.
+
+    The receiving node splits batches back into individual WHISPER messages, so it needs no
+    spool of its own, but this node must be consuming messages with Node.recv() or
+    Node.dispatch() to see peers come and go. The spool learns of peers from their ENTER
+    messages, so it must be created before the node is started.
+    """
+
+    def __init__(
+        self,
+        node, *,
+        max_memory_bytes: int = 1 << 20,
+        max_disk_bytes: int = 64 << 20,
+        max_age_ms: int = 300000,
+        batch_bytes: int = 64 << 10,
+        directory: str = None
+    ):
+        if node.running:
+            raise RuntimeError('Spool must be created before the node is started')
+        self.node = node
+        self.max_memory_bytes = max_memory_bytes
+        self.max_age_ms = max_age_ms
+        self.batch_bytes = batch_bytes
+        self.segment = _Segment(max_disk_bytes, directory) if max_disk_bytes else None
+        # peer uuid -> name, and name -> uuid of the latest node to ENTER with that name
+        self.names = {}
+        self.uuids = {}
+        self.connected = set()
+        self.evasive = set()
+        # peer uuid -> deque of (time.monotonic() sent, blob) for whispers sent while it was evasive
+        self.unconfirmed = collections.defaultdict(collections.deque)
+        # name, or uuid for peers never seen -> deque of _Entry
+        self.queues = collections.defaultdict(collections.deque)
+        # Every held _Entry in the order it was spooled, for eviction; may include ones already flushed
+        self.entries = collections.deque()
+        self.memory_bytes = 0
+        self.dropped = 0
+        node.filters.append(self.filter)
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def close(self):
+        self.node.filters.remove(self.filter)
+        if self.segment is not None:
+            self.segment.close()
+
+    async def whisper(self, peer: str, blob: Union[bytes, str]):
+        """
+        Send message to a peer, specified as a UUID string or a node name, or hold it until the peer is back.
+        """
+        if isinstance(blob, str):
+            blob = blob.encode('utf8')
+        uuid = self.uuids.get(peer, peer)
+        key = self.names.get(uuid, peer)
+        if uuid in self.connected and not self.queues.get(key):
+            if uuid in self.evasive:
+                self.confirm(uuid, expire=True)
+                self.unconfirmed[uuid].append((time.monotonic(), blob))
+            await self.node.whisper(uuid, blob)
+        else:
+            self.hold(key, blob)
+
+    def hold(self, key: str, blob: bytes):
+        self.evict()
+        entry = _Entry(key, blob)
+        capacity = self.segment.capacity if self.segment is not None else 0
+        if entry.length > max(self.max_memory_bytes, capacity):
+            self.dropped += 1
+            return
+        # Keep entry in memory if there is room, else in the segment file, else make room
+        while self.memory_bytes + entry.length > self.max_memory_bytes:
+            if entry.length <= capacity and self.segment.write(entry):
+                break
+            self.drop(self.entries.popleft())
+        else:
+            self.memory_bytes += entry.length
+        self.queues[key].append(entry)
+        self.entries.append(entry)
+
+    def drop(self, entry: '_Entry'):
+        if entry.done:
+            return
+        queue = self.queues[entry.key]
+        queue.remove(entry)
+        if not queue:
+            del self.queues[entry.key]
+        self.release(entry)
+        self.dropped += 1
+
+    def release(self, entry: '_Entry'):
+        entry.done = True
+        if entry.blob is not None:
+            self.memory_bytes -= entry.length
+        else:
+            self.segment.free(entry)
+
+    def evict(self):
+        """
+        Drop entries held for longer than max_age_ms, and forget ones already flushed.
+        """
+        expired_at = time.monotonic() - self.max_age_ms / 1000
+        while self.entries and (self.entries[0].done or self.entries[0].stored_at <= expired_at):
+            self.drop(self.entries.popleft())
+
+    def flush(self, uuid: str):
+        """
+        Send the entries held for peer uuid, by uuid or by name, in batches.
+        """
+        self.evict()
+        if not self.node.running:
+            return
+        held = []
+        for key in (uuid, self.names.get(uuid)):
+            held.extend(self.queues.pop(key, ()))
+        batch = []
+        size = 0
+        for entry in held:
+            blob = self.segment.read(entry) if entry.blob is None else entry.blob
+            self.release(entry)
+            if batch and size + len(blob) > self.batch_bytes:
+                self.node.whisper_nowait(uuid, pack(batch))
+                batch = []
+                size = 0
+            batch.append(blob)
+            size += len(blob)
+        if batch:
+            self.node.whisper_nowait(uuid, pack(batch))
+
+    def confirm(self, uuid: str, expire: bool = False):
+        """
+        Forget the copies of whispers sent to peer uuid while it was evasive, or if expire is true,
+        only those sent long enough ago that the peer would have EXITed since if it were gone.
+        """
+        copies = self.unconfirmed.get(uuid)
+        if copies is None:
+            return
+        if expire:
+            expired_at = time.monotonic() - self.node.config.expired_timeout_ms / 1000
+            while copies and copies[0][0] <= expired_at:
+                copies.popleft()
+        else:
+            copies.clear()
+        if not copies:
+            del self.unconfirmed[uuid]
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        """
+        Track which peers are present, flushing held whispers to peers that come back.
+        """
+        if msg.event == 'ENTER':
+            self.names[msg.peer] = msg.name
+            self.uuids[msg.name] = msg.peer
+            self.connected.add(msg.peer)
+            self.flush(msg.peer)
+        elif msg.event == 'EVASIVE':
+            self.evasive.add(msg.peer)
+        elif msg.event == 'EXIT':
+            self.connected.discard(msg.peer)
+            self.evasive.discard(msg.peer)
+            # Whispers sent while it was evasive may never have arrived; hold them for its return
+            self.confirm(msg.peer, expire=True)
+            key = self.names.get(msg.peer, msg.peer)
+            for _, blob in self.unconfirmed.pop(msg.peer, ()):
+                self.hold(key, blob)
+        elif msg.event != 'SILENT' and msg.peer in self.evasive:
+            # Heard from again
+            self.evasive.discard(msg.peer)
+            self.confirm(msg.peer)
+        return [msg]
+
+
+def pack(blobs: List[bytes]) -> bytes:
+    if len(blobs) == 1:
+        return blobs[0]
+    return envelopes.pack(envelopes.BATCH, *(len(blob) for blob in blobs), payload=b''.join(blobs))
+
+
+def unbatch(msg: messages.Msg) -> List[messages.Msg]:
+    """
+    Split batched whispers among received messages into individual messages.
+    """
+    if msg.event != 'WHISPER':
+        return [msg]
+    envelope = envelopes.unpack(msg.blob)
+    if envelope is None or envelope[0] != envelopes.BATCH:
+        return [msg]
+    _, fields, payload = envelope
+    msgs = []
+    offset = 0
+    for length in fields:
+        end = offset + int(length)
+        msgs.append(messages.Msg(
+            event='WHISPER', peer=msg.peer, name=msg.name, blob=payload[offset:end], trace=msg.trace))
+        offset = end
+    return msgs
+
+
+class _Entry:
+    __slots__ = ('key', 'stored_at', 'blob', 'length', 'offset', 'done')
+
+    def __init__(self, key: str, blob: bytes):
+        self.key = key
+        self.stored_at = time.monotonic()
+        # None once moved to the segment file, at offset
+        self.blob = blob
+        self.length = len(blob)
+        self.offset = None
+        self.done = False
+
+
+class _Segment:
+    """
+    Append-only memory-mapped file holding the blobs of spooled entries. Space freed in the middle
+    is reclaimed by compacting the live entries to the front when the end is reached.
+    """
+
+    def __init__(self, capacity: int, directory: Optional[str]):
+        self.capacity = capacity
+        self.directory = directory
+        self.file = None
+        self.map = None
+        self.end = 0
+        self.live_bytes = 0
+        # offset -> _Entry, for live entries
+        self.live = {}
+
+    def open(self):
+        self.file = tempfile.TemporaryFile(dir=self.directory)
+        self.file.truncate(self.capacity)
+        self.map = mmap.mmap(self.file.fileno(), self.capacity)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = self.file = None
+
+    def write(self, entry: _Entry) -> bool:
+        if self.map is None:
+            self.open()
+        if self.end + entry.length > self.capacity:
+            if self.live_bytes + entry.length > self.capacity:
+                return False
+            self.compact()
+        self.map[self.end:self.end + entry.length] = entry.blob
+        entry.offset = self.end
+        entry.blob = None
+        self.live[entry.offset] = entry
+        self.end += entry.length
+        self.live_bytes += entry.length
+        return True
+
+    def read(self, entry: _Entry) -> bytes:
+        return self.map[entry.offset:entry.offset + entry.length]
+
+    def free(self, entry: _Entry):
+        del self.live[entry.offset]
+        self.live_bytes -= entry.length
+        if not self.live:
+            self.end = 0
+
+    def compact(self):
+        end = 0
+        live = {}
+        for offset in sorted(self.live):
+            entry = self.live[offset]
+            if offset != end:
+                self.map.move(end, offset, entry.length)
+                entry.offset = end
+            live[end] = entry
+            end += entry.length
+        self.live = live
+        self.end = end
@@ -0,0 +1,211 @@
+import json
+import time
+
+from typing import Any, Dict, Iterator, List, Mapping, Tuple
+
+from . import envelopes
+from . import messages
+
+
+class GroupState:
+    """
+    A key-value map replicated among the members of a group.
+
+    Writes apply locally at once and are shouted to the group as deltas. Each entry carries a
+    version of (Lamport clock, origin node uuid), and the highest version of a key wins, so
+    members converge whatever order deltas arrive in. When a peer joins the group, the member
+    with the lowest uuid whispers it a snapshot of the current entries, which brings a late
+    joiner up to date. Since members' views of the group may differ, a member which has had no
+    snapshot within snapshot_timeout_ms of seeing others in the group asks each of them for one
+    in turn; if none has anything to send, the group has no entries yet.
+
+    Only the latest version of each key is kept; deleted keys are remembered as tombstones for
+    tombstone_ttl_ms, so that stale snapshots cannot bring them back, and are then compacted away.
+    A member partitioned for longer than that may resurrect a deleted key when it returns.
+
+    Reads are local and never wait on the network. Values must be JSON serializable. The node
+    must be a member of the group to receive deltas, and must be consuming messages with
+    Node.recv() or Node.dispatch() for deltas and snapshots to be applied.
+    """
+
+    def __init__(self, node, group: str, *, tombstone_ttl_ms: int = 60000, snapshot_timeout_ms: int = 1000):
+        self.node = node
+        self.group = group
+        self.tombstone_ttl_ms = tombstone_ttl_ms
+        self.snapshot_timeout_ms = snapshot_timeout_ms
+        self.clock = 0
+        # key -> value
+        self.entries = {}
+        # key -> (clock, origin), for live entries and tombstones alike
+        self.versions = {}
+        # key -> time.monotonic() of deletion
+        self.tombstones = {}
+        # uuids of the other members of the group
+        self.members = set()
+        # Whether a snapshot has arrived, and the pending timer and count of requests for one
+        self.synced = False
+        self.timer = None
+        self.requests = 0
+        node.filters.append(self.filter)
+
+    def close(self):
+        """
+        Stop applying deltas and snapshots; the entries remain readable.
+        """
+        self.node.filters.remove(self.filter)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def __getitem__(self, key: str) -> Any:
+        return self.entries[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.entries.get(key, default)
+
+    def items(self):
+        return self.entries.items()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.entries)
+
+    async def set(self, key: str, value: Any):
+        """
+        Set key to value, and send the change to the group.
+        """
+        await self.update({key: value})
+
+    async def delete(self, key: str):
+        """
+        Delete key, and send the deletion to the group.
+        """
+        await self.write([self.apply(key, None, self.tick(), deleted=True)])
+
+    async def update(self, mapping: Mapping[str, Any]):
+        """
+        Set several keys at once, sending the changes to the group together.
+        """
+        clock = self.tick()
+        await self.write([self.apply(key, value, clock) for key, value in mapping.items()])
+
+    def tick(self) -> Tuple[int, str]:
+        self.clock += 1
+        return self.clock, self.node.uuid
+
+    def apply(self, key: str, value: Any, version: Tuple[int, str], deleted: bool = False) -> List:
+        """
+        Apply one change if it is newer than what we have, returning it in wire form.
+        """
+        current = self.versions.get(key)
+        if current is None or tuple(version) > current:
+            self.versions[key] = tuple(version)
+            if deleted:
+                self.entries.pop(key, None)
+                self.tombstones[key] = time.monotonic()
+            else:
+                self.entries[key] = value
+                self.tombstones.pop(key, None)
+        return [key, value, version[0], version[1], deleted]
+
+    def merge(self, changes: List[List]):
+        for key, value, clock, origin, deleted in changes:
+            self.clock = max(self.clock, clock)
+            self.apply(key, value, (clock, origin), deleted)
+        self.compact()
+
+    def compact(self):
+        if not self.tombstones:
+            return
+        expired_at = time.monotonic() - self.tombstone_ttl_ms / 1000
+        for key in [key for key, deleted_at in self.tombstones.items() if deleted_at <= expired_at]:
+            del self.tombstones[key]
+            del self.versions[key]
+
+    def snapshot(self) -> List[List]:
+        self.compact()
+        return [
+            [key, self.entries.get(key), clock, origin, key in self.tombstones]
+            for key, (clock, origin) in self.versions.items()
+        ]
+
+    def send_snapshot(self, peer: str):
+        # A member which has neither entries nor a snapshot of its own has nothing worth sending
+        if (self.synced or self.versions) and self.node.running:
+            self.node.whisper_nowait(
+                peer, envelopes.pack(envelopes.STATE_SNAPSHOT, payload=self.encode(self.snapshot())))
+
+    def await_snapshot(self):
+        if not self.synced and self.timer is None:
+            self.timer = self.node.loop.call_later(self.snapshot_timeout_ms / 1000, self.request_snapshot)
+
+    def request_snapshot(self):
+        """
+        Ask the next member, in uuid order, for a snapshot, and try again later if none arrives.
+        """
+        self.timer = None
+        if self.synced or not self.node.running:
+            return
+        members = sorted(self.members)
+        if self.requests >= len(members):
+            # Nobody had anything to send, so we are as up to date as any member
+            self.synced = True
+            return
+        peer = members[self.requests]
+        self.requests += 1
+        self.node.whisper_nowait(peer, envelopes.pack(envelopes.STATE_REQUEST, payload=self.encode([])))
+        self.await_snapshot()
+
+    async def write(self, changes: List[List]):
+        self.compact()
+        await self.node.shout(self.group, envelopes.pack(envelopes.STATE_DELTA, payload=self.encode(changes)))
+
+    def encode(self, changes: List[List]) -> bytes:
+        # ASCII-only JSON escapes NUL, so the blob survives zyre's C strings
+        return json.dumps({'group': self.group, 'changes': changes}).encode('ascii')
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        """
+        Apply deltas and snapshots for this group among received messages, and send
+        a snapshot to each peer that joins the group if this node is the one to.
+        """
+        if msg.event == 'JOIN':
+            if msg.group == self.group:
+                # Only the member with the lowest uuid that we know of answers, sparing the joiner
+                # a copy from every member; the joiner asks again if views differ and none does
+                others = self.members - {msg.peer}
+                if not others or self.node.uuid < min(others):
+                    self.send_snapshot(msg.peer)
+                self.members.add(msg.peer)
+                self.await_snapshot()
+            return [msg]
+        if (msg.event == 'LEAVE' and msg.group == self.group) or msg.event == 'EXIT':
+            self.members.discard(msg.peer)
+            return [msg]
+        if msg.event not in ('SHOUT', 'WHISPER'):
+            return [msg]
+        envelope = envelopes.unpack(msg.blob)
+        if envelope is None:
+            return [msg]
+        kind, fields, payload = envelope
+        if kind not in (envelopes.STATE_DELTA, envelopes.STATE_SNAPSHOT, envelopes.STATE_REQUEST):
+            return [msg]
+        data = json.loads(payload.decode('ascii'))
+        if data['group'] != self.group:
+            # For another GroupState on this node
+            return [msg]
+        if kind == envelopes.STATE_REQUEST:
+            self.send_snapshot(msg.peer)
+            return []
+        if kind == envelopes.STATE_SNAPSHOT:
+            self.synced = True
+        self.merge(data['changes'])
+        return []
@@ -0,0 +1,148 @@
+import collections
+import time
+
+from typing import Dict, List, Optional
+
+from . import envelopes
+from . import messages
+
+
+# Stages of a traced message's trip:
+#   queue    from the sender's shout()/whisper() call until its zactor handed the message to zyre
+#   network  from then until our zactor received it, corrected for the clock offset between the nodes
+#   outbox   from then until it was taken from our outbox by recv()
+#   total    the sum of the above
+STAGES = ('queue', 'network', 'outbox', 'total')
+
+
+def stamp(blob: bytes, queued_at: float) -> bytes:
+    """
+    Wrap an outgoing blob in a trace envelope carrying the time it was queued and the time it is sent.
+    """
+    return envelopes.pack(envelopes.TRACE, '%.6f' % queued_at, '%.6f' % time.time(), payload=blob)
+
+
+def unwrap(blob: bytes) -> Optional[bytes]:
+    """
+    Return the blob inside a trace envelope, or None if blob is not one.
+    """
+    envelope = envelopes.unpack(blob)
+    if envelope is None or envelope[0] != envelopes.TRACE:
+        return None
+    return envelope[2]
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets: bucket i counts latencies from 2 ** (i - 1)
+    up to 2 ** i microseconds, so percentiles are accurate to within a factor of two.
+    """
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds: float):
+        seconds = max(seconds, 0.0)
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other: 'Histogram') -> 'Histogram':
+        """
+        Return a new histogram combining this one's counts with other's.
+        """
+        merged = Histogram()
+        for histogram in (self, other):
+            merged.buckets.update(histogram.buckets)
+            merged.count += histogram.count
+            merged.sum += histogram.sum
+            for value in (histogram.min, histogram.max):
+                if value is not None:
+                    merged.min = value if merged.min is None else min(merged.min, value)
+                    merged.max = value if merged.max is None else max(merged.max, value)
+        return merged
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        Upper bound of the bucket holding the p-th percentile, in seconds.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return dict(
+            count=self.count, mean=self.mean, min=self.min, max=self.max,
+            p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={}'.format(key, value) for key, value in self.to_dict().items()))
+
+
+class Tracer:
+    """
+    Latency histograms for traced messages, per peer and per group.
+
+    Nodes created with trace=True wrap the blobs they send in a trace envelope stamped with
+    when the message was queued and when it was sent, and note when each message arrives.
+    Clocks are assumed to agree unless ping_interval_ms is set, in which case each peer's clock
+    offset is estimated from pings, NTP-style.
+
+    Trace envelopes are unwrapped on every node, whether or not it traces itself.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        # peer -> stage -> Histogram
+        self.peers = collections.defaultdict(lambda: collections.defaultdict(Histogram))
+        # group -> stage -> Histogram, for shouts
+        self.groups = collections.defaultdict(lambda: collections.defaultdict(Histogram))
+
+    def filter(self, msg: messages.Msg) -> List[messages.Msg]:
+        """
+        Unwrap traced messages among received messages, recording how long each stage took.
+        """
+        if msg.event == 'EXIT':
+            # A restarted peer comes back with a new uuid, so don't keep histograms for gone ones
+            self.peers.pop(msg.peer, None)
+            return [msg]
+        if msg.event not in ('SHOUT', 'WHISPER'):
+            return [msg]
+        envelope = envelopes.unpack(msg.blob)
+        if envelope is None or envelope[0] != envelopes.TRACE:
+            return [msg]
+        _, fields, msg.blob = envelope
+        if msg.trace is not None:
+            queued_at, sent_at = float(fields[0]), float(fields[1])
+            offset = self.node.stats.offsets.get(msg.peer, 0.0)
+            trace = msg.trace
+            trace.update(queued_at=queued_at, sent_at=sent_at, delivered_at=time.time())
+            trace['queue'] = sent_at - queued_at
+            trace['network'] = trace['received_at'] - sent_at + offset
+            trace['outbox'] = trace['delivered_at'] - trace['received_at']
+            trace['total'] = trace['queue'] + trace['network'] + trace['outbox']
+            histograms = [self.peers[msg.peer]]
+            if msg.event == 'SHOUT':
+                histograms.append(self.groups[msg.group])
+            for stage in STAGES:
+                for histogram in histograms:
+                    histogram[stage].add(trace[stage])
+        return [msg]
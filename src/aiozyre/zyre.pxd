@@ -29,6 +29,12 @@ cdef extern from "zyre.h" nogil:
 
     void zsock_destroy (zsock_t **self_p)
 
+    zsock_t * zsock_new_push (const char *endpoint)
+
+    zsock_t * zsock_new_pull (const char *endpoint)
+
+    void zsock_set_sndtimeo (void *self, int sndtimeo)
+
     # zlist.h
 
     ctypedef struct zlist_t
@@ -110,6 +116,11 @@ cdef extern from "zyre.h" nogil:
 
     void zyre_set_port(zyre_t *self, int port_nbr)
 
+    void zyre_set_interval(zyre_t * self, size_t interval)
+
+    # Draft API, see DRAFT_API below
+    void zyre_set_silent_timeout(zyre_t * self, int interval)
+
     void zyre_gossip_bind(zyre_t * self, char * fmt, char * value)
 
     void zyre_gossip_connect(zyre_t * self, char * fmt, char * value)
@@ -147,3 +158,18 @@ cdef extern from "zyre.h" nogil:
     zsock_t * zyre_socket(zyre_t * self)
 
     uint64_t zyre_version()
+
+
+cdef extern from *:
+    """
+    /* zyre.h only declares its draft API when ZYRE_BUILD_DRAFT_API is defined, which setup.py does
+       when AIOZYRE_DRAFT_API=1; otherwise stub it out, as stock zyre builds don't export it */
+    #ifdef ZYRE_BUILD_DRAFT_API
+    #define AIOZYRE_DRAFT_API 1
+    #else
+    #define AIOZYRE_DRAFT_API 0
+    #define zyre_set_silent_timeout(self, interval) ((void) 0)
+    #endif
+    """
+    # Whether aiozyre was built against zyre's draft API
+    bint DRAFT_API "AIOZYRE_DRAFT_API"
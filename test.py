@@ -11,13 +11,19 @@ else:
     tracemalloc.start()
 
 import asyncio
+import concurrent.futures
 import sys
 import unittest
+import zlib
 
 from pprint import pformat
 
 
-from aiozyre import Node, Stopped
+from aiozyre import BlockingNode, GroupState, Mesh, Msg, Node, Spool, StopReport, Stopped, Unreachable
+from aiozyre import envelopes
+from aiozyre.load import LoadWorker, merge, summarize
+from aiozyre.nodeconfig import NodeConfig
+from aiozyre.offload import ProcessStage
 
 
 class AIOZyreTestCase(unittest.TestCase):
@@ -98,6 +104,14 @@ class AIOZyreTestCase(unittest.TestCase):
     def test_timeout(self):
         self.loop.run_until_complete(self.timeout())
 
+    def test_blocking(self):
+        self.loop.run_until_complete(self.blocking())
+
+    def test_stop_drain(self):
+        self.loop.run_until_complete(self.stop_drain())
+        for i in range(100):
+            self.assert_received_message('buzz', event='WHISPER', blob=b'Hello #%d from fizz' % i)
+
     def assert_received_message(self, node_name, **kwargs):
         match = False
         for msg in self.nodes[node_name]['messages']:
@@ -148,6 +162,70 @@ class AIOZyreTestCase(unittest.TestCase):
         finally:
             await fizz.stop()
 
+    async def blocking(self):
+        fizz = await self.start('fizz', groups=['test'])
+        buzz = await self.start('buzz', groups=['test'])
+        # Give some time for the nodes to discover each other
+        await asyncio.sleep(1)
+        sender = BlockingNode(fizz, timeout=5)
+        receiver = BlockingNode(buzz, receive=True, timeout=5)
+
+        def produce(i):
+            sender.whisper(buzz.uuid, 'Hello #%d from fizz' % i)
+
+        def work():
+            self.assertEqual(sender.peers(), {buzz.uuid})
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                list(executor.map(produce, range(8)))
+                sender.shout('test', 'Hello test from fizz')
+            messages = []
+            while len(messages) < 9:
+                msg = receiver.recv(timeout=5)
+                if msg.event in ('SHOUT', 'WHISPER'):
+                    messages.append(msg)
+            return messages
+
+        messages = await self.loop.run_in_executor(None, work)
+        self.assertEqual(
+            sorted(msg.blob for msg in messages if msg.event == 'WHISPER'),
+            sorted(b'Hello #%d from fizz' % i for i in range(8)))
+        self.assertEqual([msg.blob for msg in messages if msg.event == 'SHOUT'], [b'Hello test from fizz'])
+
+        # A thread blocked in recv() is woken when the node stops
+        blocked = self.loop.run_in_executor(None, receiver.recv)
+        await asyncio.sleep(0.1)
+        await buzz.stop()
+        with self.assertRaises(Stopped):
+            await blocked
+        await fizz.stop()
+        with self.assertRaises(Stopped):
+            sender.peers()
+
+    async def stop_drain(self):
+        fizz = await self.start('fizz')
+        buzz = await self.start('buzz')
+        self.listen(buzz)
+        # Give some time for the nodes to discover each other
+        await asyncio.sleep(1)
+        for i in range(100):
+            fizz.whisper_nowait(buzz.uuid, 'Hello #%d from fizz' % i)
+        report = await fizz.stop(drain=True, timeout=5)
+        self.assertFalse(report.timed_out)
+        self.assertEqual(report.drained, 100)
+        self.assertEqual(report.dropped, [])
+
+        # Without draining, queued whispers are failed with Stopped
+        await fizz.start()
+        pending = [fizz.whisper_nowait(buzz.uuid, 'Lost #%d from fizz' % i) for i in range(10)]
+        report = await fizz.stop()
+        self.assertEqual(report.dropped, pending)
+        for fut in pending:
+            with self.assertRaises(Stopped):
+                await fut
+        # Give some time to receive messages
+        await asyncio.sleep(1)
+        await buzz.stop()
+
     async def start_stop(self):
         fizz = await self.start('fizz', groups=['test'])
         buzz = await self.start('buzz', groups=['test'])
@@ -226,5 +304,617 @@ class AIOZyreTestCase(unittest.TestCase):
             return self.loop.create_task(coro)
 
 
+def checksum(blob):
+    return zlib.crc32(blob)
+
+
+class MeshTestCase(unittest.TestCase):
+    __slots__ = ('loop', )
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def test_large_cluster(self):
+        self.loop.run_until_complete(self.large_cluster())
+
+    def test_partition(self):
+        self.loop.run_until_complete(self.partition())
+
+    def test_link_order(self):
+        self.loop.run_until_complete(self.link_order())
+
+    def test_dispatch(self):
+        self.loop.run_until_complete(self.dispatch())
+
+    def test_offload(self):
+        self.loop.run_until_complete(self.offload())
+
+    def test_whisper_reliable(self):
+        self.loop.run_until_complete(self.whisper_reliable())
+
+    def test_pick_peer(self):
+        self.loop.run_until_complete(self.pick_peer())
+
+    def test_load(self):
+        self.loop.run_until_complete(self.load())
+
+    def test_group_state(self):
+        self.loop.run_until_complete(self.group_state())
+
+    def test_conflate(self):
+        self.loop.run_until_complete(self.conflate())
+
+    def test_trace(self):
+        self.loop.run_until_complete(self.trace())
+
+    def test_spool(self):
+        self.loop.run_until_complete(self.spool())
+
+    def test_blocking(self):
+        self.loop.run_until_complete(self.blocking())
+
+    def test_stop_drain(self):
+        self.loop.run_until_complete(self.stop_drain())
+
+    async def start(self, mesh, count, **kwargs):
+        nodes = [Node('node%d' % i, mesh=mesh, loop=self.loop, **kwargs) for i in range(count)]
+        for node in nodes:
+            await node.start()
+        return nodes
+
+    async def consume(self, node):
+        while True:
+            try:
+                await node.recv()
+            except Stopped:
+                break
+
+    async def drain(self, node):
+        messages = []
+        while True:
+            try:
+                messages.append(await node.recv(timeout=0.01))
+            except asyncio.TimeoutError:
+                return messages
+
+    async def large_cluster(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        nodes = await self.start(mesh, 100, groups=['all'], headers={'role': 'worker'})
+        await asyncio.sleep(0.05)
+        for node in nodes:
+            await node.shout('all', 'Hello from %s' % node.name)
+        for node in nodes:
+            events = [msg.event for msg in await self.drain(node)]
+            self.assertEqual(events.count('ENTER'), 99)
+            self.assertEqual(events.count('JOIN'), 99)
+            self.assertEqual(events.count('SHOUT'), 99)
+        self.assertEqual(len(await nodes[0].peers_by_group('all')), 99)
+        self.assertEqual(await nodes[0].peer_header_value(nodes[1].uuid, 'role'), 'worker')
+        for node in nodes:
+            await node.stop()
+
+    async def partition(self):
+        mesh = Mesh(seed=0)
+        a, b, c = await self.start(mesh, 3, groups=['all'], evasive_timeout_ms=50, expired_timeout_ms=100)
+        await asyncio.sleep(0)
+        await self.drain(a)
+        mesh.partition(['node0'])
+        await b.shout('all', 'unreachable')
+        await asyncio.sleep(0.15)
+        events = [(msg.event, msg.name) for msg in await self.drain(a)]
+        self.assertEqual(events, [
+            ('EVASIVE', 'node1'), ('EVASIVE', 'node2'), ('EXIT', 'node1'), ('EXIT', 'node2')])
+        self.assertEqual(await a.peers(), set())
+        self.assertEqual(await b.peers(), {c.uuid})
+        mesh.heal()
+        await asyncio.sleep(0)
+        self.assertEqual(await a.peers(), {b.uuid, c.uuid})
+        self.assertEqual(await a.peers_by_group('all'), {b.uuid, c.uuid})
+        for node in (a, b, c):
+            await node.stop()
+
+    async def link_order(self):
+        mesh = Mesh(latency_ms=5, jitter_ms=20, seed=0)
+        mesh.configure_link('node0', 'node2', loss=1.0)
+        a, b, c = await self.start(mesh, 3)
+        await asyncio.sleep(0.05)
+        for i in range(100):
+            await a.whisper(b.uuid, str(i))
+            await a.whisper(c.uuid, str(i))
+        await asyncio.sleep(0.1)
+        received = [msg.string for msg in await self.drain(b) if msg.event == 'WHISPER']
+        self.assertEqual(received, [str(i) for i in range(100)])
+        self.assertFalse([msg for msg in await self.drain(c) if msg.event == 'WHISPER'])
+        for node in (a, b, c):
+            await node.stop()
+        with self.assertRaises(Stopped):
+            await self.drain(a)
+
+    async def dispatch(self):
+        mesh = Mesh(seed=0)
+        a, b, c = await self.start(mesh, 3, groups=['work'])
+        handled = []
+        # node1's messages are slow (held up until node2's have been handled), but must not hold up node2's
+        unblocked = asyncio.Event()
+        finished = asyncio.Event()
+
+        @a.on('SHOUT', 'work')
+        async def work(msg):
+            if msg.name == 'node1':
+                await unblocked.wait()
+            handled.append((msg.name, msg.string))
+            shouts = [name for name, string in handled if string != 'ENTER']
+            if shouts.count('node2') == 5:
+                unblocked.set()
+            if len(shouts) == 10:
+                finished.set()
+
+        a.on('ENTER', handler=lambda msg: handled.append((msg.name, 'ENTER')))
+        dispatching = self.loop.create_task(a.dispatch(concurrency=2))
+        await asyncio.sleep(0)
+        for i in range(5):
+            await b.shout('work', str(i))
+            await c.shout('work', str(i))
+        await asyncio.wait_for(finished.wait(), timeout=5)
+        await a.stop()
+        await dispatching
+        self.assertEqual(handled[:2], [('node1', 'ENTER'), ('node2', 'ENTER')])
+        self.assertEqual([string for name, string in handled if name == 'node1'][1:], ['0', '1', '2', '3', '4'])
+        self.assertEqual([string for name, string in handled if name == 'node2'][1:], ['0', '1', '2', '3', '4'])
+        self.assertEqual(handled[2:7], [('node2', str(i)) for i in range(5)])
+        for node in (b, c):
+            await node.stop()
+
+    async def offload(self):
+        mesh = Mesh(seed=0)
+        a, b, c = await self.start(mesh, 3, groups=['data'])
+        results = []
+        with ProcessStage(checksum, workers=2, shm_threshold=1024) as stage:
+            a.on('SHOUT', 'data', stage.handler(lambda msg, result: results.append((msg.name, result))))
+            dispatching = self.loop.create_task(a.dispatch())
+            blobs = [b'x' * size for size in (10, 2000, 20, 100000)]
+            for blob in blobs:
+                await b.shout('data', blob)
+                await c.shout('data', blob)
+            await asyncio.sleep(0.5)
+            await a.stop()
+            await dispatching
+        for name in ('node1', 'node2'):
+            self.assertEqual([result for n, result in results if n == name], [zlib.crc32(blob) for blob in blobs])
+        for node in (b, c):
+            await node.stop()
+
+    async def whisper_reliable(self):
+        mesh = Mesh(latency_ms=2, jitter_ms=4, loss=0.3, seed=0)
+        a, b = await self.start(mesh, 2)
+        a.reliable.window = 16
+        a.reliable.min_timeout_ms = 20
+        received = []
+
+        async def listen(node):
+            while True:
+                try:
+                    msg = await node.recv()
+                except Stopped:
+                    break
+                if msg.event == 'WHISPER':
+                    received.append(msg.string)
+
+        # The sender must consume messages too, as that is how it receives acknowledgements
+        listening = [self.loop.create_task(listen(node)) for node in (a, b)]
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(asyncio.gather(*(a.whisper_reliable(b.uuid, str(i)) for i in range(200))), 10)
+        self.assertEqual(received, [str(i) for i in range(200)])
+        self.assertFalse(a.reliable.senders[b.uuid].unacked)
+
+        # Sends which time out while waiting for room in the window are never sent, but ones
+        # already sent are still retransmitted
+        a.reliable.window = 2
+        received.clear()
+        mesh.configure_link('node0', 'node1', loss=1.0)
+        for i in range(4):
+            with self.assertRaises(asyncio.TimeoutError):
+                await a.whisper_reliable(b.uuid, 'late %d' % i, timeout=0.01)
+        mesh.configure_link('node0', 'node1', loss=0.0)
+        await a.whisper_reliable(b.uuid, 'after', timeout=5)
+        self.assertEqual(received, ['late 0', 'late 1', 'after'])
+
+        # A peer which acknowledges nothing despite retransmissions is given up on, and
+        # later sends start over with a new epoch
+        a.reliable.max_retransmits = 2
+        a.reliable.max_timeout_ms = 40
+        mesh.configure_link('node0', 'node1', loss=1.0)
+        with self.assertRaises(Unreachable):
+            await a.whisper_reliable(b.uuid, 'unacknowledged', timeout=5)
+        self.assertNotIn(b.uuid, a.reliable.senders)
+        mesh.configure_link('node0', 'node1', loss=0.0)
+        await a.whisper_reliable(b.uuid, 'again', timeout=5)
+        self.assertEqual(received[-1], 'again')
+
+        mesh.configure_link('node0', 'node1', loss=1.0)
+        sending = self.loop.create_task(a.whisper_reliable(b.uuid, 'lost'))
+        await asyncio.sleep(0.05)
+        await b.stop()
+        mesh.configure_link('node0', 'node1', loss=0.0)
+        with self.assertRaises(Unreachable):
+            await sending
+        await a.stop()
+        await asyncio.wait(listening)
+
+    async def pick_peer(self):
+        mesh = Mesh(seed=0)
+        mesh.configure_link('node0', 'node1', latency_ms=20)
+        nodes = await self.start(
+            mesh, 3, groups=['service'], ping_interval_ms=10, evasive_timeout_ms=50, expired_timeout_ms=10000)
+        a, b, c = nodes
+        b.stats.load = 1
+        c.stats.load = 5
+        listening = [self.loop.create_task(self.consume(node)) for node in nodes]
+        await asyncio.sleep(0.2)
+        self.assertGreater(a.stats.get(b.uuid)['rtt'], a.stats.get(c.uuid)['rtt'])
+        self.assertEqual(await a.pick_peer('service', 'least-latency'), c.uuid)
+        self.assertEqual(await a.pick_peer('service', 'least-loaded'), b.uuid)
+        self.assertEqual(await a.pick_peer('service', 'power-of-two'), b.uuid)
+        self.assertEqual(
+            {await a.pick_peer('service', 'round-robin'), await a.pick_peer('service', 'round-robin')},
+            {b.uuid, c.uuid})
+        self.assertIsNone(await a.pick_peer('nobody'))
+
+        # node1 becomes unreachable, and is avoided once evasive
+        mesh.partition(['node0', 'node2'])
+        await asyncio.sleep(0.1)
+        self.assertEqual(await a.pick_peer('service', 'least-loaded'), c.uuid)
+        for node in nodes:
+            await node.stop()
+        await asyncio.wait(listening)
+
+    async def load(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        nodes = await self.start(mesh, 4, groups=['load'])
+        worker = LoadWorker(nodes, rate=100, shout_ratio=0.5, sizes=(16, 1024), seed=0)
+        stop_at = self.loop.time() + 0.3
+        await worker.run(peers=3, stopping=lambda: self.loop.time() >= stop_at)
+        report = worker.report()
+        self.assertGreater(report['sent'], 0)
+        self.assertGreater(report['received'], report['sent'])
+        self.assertEqual(report['dropped'], 0)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['latencies'].count, report['received'])
+        self.assertGreater(report['rss'], 0)
+        merged = merge(report, report)
+        self.assertEqual(merged['latencies'].count, 2 * report['received'])
+        self.assertEqual(merged['latencies'].percentile(99), report['latencies'].percentile(99))
+        self.assertIn('p99', summarize([merged], 1, report['rss'], report['rss']))
+
+        # Lost messages are counted as dropped
+        mesh = Mesh(loss=0.2, seed=0)
+        nodes = await self.start(mesh, 2, groups=['load'])
+        worker = LoadWorker(nodes, rate=200, seed=0)
+        stop_at = self.loop.time() + 0.3
+        await worker.run(peers=1, stopping=lambda: self.loop.time() >= stop_at)
+        report = worker.report()
+        self.assertGreater(report['dropped'], 0)
+
+    async def group_state(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        a, b = await self.start(mesh, 2, groups=['config'])
+        states = {node: GroupState(node, 'config', tombstone_ttl_ms=50) for node in (a, b)}
+        listening = [self.loop.create_task(self.consume(node)) for node in (a, b)]
+        await asyncio.sleep(0.05)
+        await states[a].set('color', 'red')
+        await states[b].update({'size': 3, 'shape': {'sides': 4}})
+        await states[a].set('doomed', True)
+        await asyncio.sleep(0.05)
+        await states[b].delete('doomed')
+        await asyncio.sleep(0.05)
+        self.assertEqual(states[b]['color'], 'red')
+        self.assertEqual(states[a].get('shape'), {'sides': 4})
+        self.assertNotIn('doomed', states[a])
+
+        # Concurrent writes converge on the same value
+        await asyncio.gather(states[a].set('color', 'green'), states[b].set('color', 'blue'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(states[a]['color'], states[b]['color'])
+
+        # A late joiner receives a single snapshot; tombstones have been compacted by then
+        snapshots = []
+
+        def count(msg):
+            if msg.event == 'WHISPER' and msg.blob.startswith(envelopes.PREFIX + envelopes.STATE_SNAPSHOT):
+                snapshots.append(msg.peer)
+            return [msg]
+
+        c = Node('late', mesh=mesh, loop=self.loop)
+        await c.start()
+        c.filters.insert(0, count)
+        states[c] = GroupState(c, 'config')
+        listening.append(self.loop.create_task(self.consume(c)))
+        await c.join('config')
+        await asyncio.sleep(0.05)
+        self.assertEqual(states[c].to_dict(), states[a].to_dict())
+        self.assertEqual(len(states[c]), 3)
+        self.assertNotIn('doomed', states[a].versions)
+        self.assertEqual(snapshots, [min(a.uuid, b.uuid)])
+
+        # If the member due to send a snapshot doesn't, the joiner asks the others in turn
+        sender = min((a, b, c), key=lambda node: node.uuid)
+        states[sender].close()
+        d = Node('later', mesh=mesh, loop=self.loop)
+        await d.start()
+        states[d] = GroupState(d, 'config', snapshot_timeout_ms=50)
+        listening.append(self.loop.create_task(self.consume(d)))
+        await d.join('config')
+        await asyncio.sleep(0.3)
+        self.assertEqual(states[d].to_dict(), states[a].to_dict())
+        self.assertTrue(states[d].synced)
+        for node in (a, b, c, d):
+            await node.stop()
+        await asyncio.wait(listening)
+
+    async def conflate(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        publisher = Node('publisher', mesh=mesh, loop=self.loop, groups=['prices'])
+        subscriber = Node(
+            'subscriber', mesh=mesh, loop=self.loop, groups=['prices'],
+            conflate=lambda msg: (msg.peer, msg.group, msg.blob.split(b'=')[0]) if b'=' in msg.blob else None)
+        await publisher.start()
+        await subscriber.start()
+        await asyncio.sleep(0.05)
+        for i in range(100):
+            await publisher.shout('prices', 'AAPL=%d' % i)
+            await publisher.shout('prices', 'MSFT=%d' % (i * 2))
+        await publisher.shout('prices', 'close')
+        await publisher.shout('prices', 'AAPL=100')
+        await asyncio.sleep(0.05)
+        messages = [msg for msg in await self.drain(subscriber) if msg.event == 'SHOUT']
+        # The latest value per key, in the position of the first
+        self.assertEqual([msg.blob for msg in messages], [b'AAPL=100', b'MSFT=198', b'close'])
+        self.assertEqual(subscriber.actor.outbox.conflated, 199)
+        for node in (publisher, subscriber):
+            await node.stop()
+
+    async def trace(self):
+        mesh = Mesh(latency_ms=20, seed=0)
+        a, b = await self.start(mesh, 2, groups=['traced'], trace=True, ping_interval_ms=10)
+        untraced = Node('untraced', mesh=mesh, loop=self.loop, groups=['traced'])
+        await untraced.start()
+        listening = [self.loop.create_task(self.consume(a))]
+        await asyncio.sleep(0.1)
+        await a.shout('traced', 'Hello group')
+        await a.whisper(b.uuid, 'Hello b')
+        await asyncio.sleep(0.1)
+        received = [msg for msg in await self.drain(b) if msg.event in ('SHOUT', 'WHISPER')]
+        self.assertEqual([msg.blob for msg in received], [b'Hello group', b'Hello b'])
+        for msg in received:
+            # At least the link's latency, less some error in the estimated clock offset
+            self.assertGreater(msg.trace['network'], 0.015)
+            self.assertGreaterEqual(msg.trace['queue'], 0)
+            self.assertGreaterEqual(msg.trace['outbox'], 0.05)
+            self.assertAlmostEqual(
+                msg.trace['total'], msg.trace['queue'] + msg.trace['network'] + msg.trace['outbox'])
+        self.assertIn('trace=', repr(received[0]))
+        # Pings are traced too, though not delivered to the application
+        self.assertGreater(b.tracer.peers[a.uuid]['network'].count, 2)
+        self.assertEqual(b.tracer.groups['traced']['total'].count, 1)
+        self.assertAlmostEqual(b.stats.offsets[a.uuid], 0, delta=0.005)
+
+        # A node which doesn't trace still receives plain blobs
+        received = [msg for msg in await self.drain(untraced) if msg.event in ('SHOUT', 'WHISPER')]
+        self.assertEqual([(msg.blob, msg.trace) for msg in received], [(b'Hello group', None)])
+
+        # Histograms of peers which have exited are dropped
+        await a.stop()
+        await asyncio.sleep(0.1)
+        await self.drain(b)
+        self.assertNotIn(a.uuid, b.tracer.peers)
+        self.assertEqual(b.tracer.groups['traced']['total'].count, 1)
+        for node in (b, untraced):
+            await node.stop()
+        await asyncio.wait(listening)
+        self.assertNotIn('trace=', repr(Msg(event='SHOUT')))
+
+    async def spool(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        sender = Node('sender', mesh=mesh, loop=self.loop)
+        spool = Spool(sender, max_memory_bytes=100, max_disk_bytes=1000, batch_bytes=200)
+        await sender.start()
+        # The spool must see peers enter
+        with self.assertRaises(RuntimeError):
+            Spool(sender)
+        listening = [self.loop.create_task(self.consume(sender))]
+        # Held for a peer not seen yet, overflowing to the segment file
+        for i in range(50):
+            await spool.whisper('receiver', 'msg %02d' % i)
+        self.assertEqual(len(spool), 50)
+        self.assertLessEqual(spool.memory_bytes, 100)
+        self.assertEqual(spool.segment.live_bytes, 50 * 6 - spool.memory_bytes)
+
+        receiver = Node('receiver', mesh=mesh, loop=self.loop)
+        await receiver.start()
+        await asyncio.sleep(0.05)
+        # ENTER, then two batches of up to 200 bytes
+        self.assertEqual(receiver.actor.outbox.qsize(), 3)
+        whispers = [msg for msg in await self.drain(receiver) if msg.event == 'WHISPER']
+        self.assertEqual([msg.blob for msg in whispers], [b'msg %02d' % i for i in range(50)])
+        self.assertEqual((len(spool), spool.memory_bytes, spool.segment.live_bytes), (0, 0, 0))
+
+        # Connected peers are whispered at once, even when evasive
+        await spool.whisper(receiver.uuid, 'direct')
+        spool.filter(Msg(event='EVASIVE', peer=receiver.uuid, name='receiver'))
+        await spool.whisper('receiver', 'evasive')
+        self.assertEqual(len(spool), 0)
+        await asyncio.sleep(0.05)
+        self.assertEqual([msg.blob for msg in await self.drain(receiver)], [b'direct', b'evasive'])
+        # ...keeping a copy until the peer is heard from again
+        self.assertEqual(len(spool.unconfirmed[receiver.uuid]), 1)
+        spool.filter(Msg(event='WHISPER', peer=receiver.uuid, name='receiver', blob=b'reply'))
+        self.assertNotIn(receiver.uuid, spool.unconfirmed)
+
+        # Held for a peer which exited, along with whispers sent while it was evasive, and
+        # flushed to the node which takes its name
+        spool.filter(Msg(event='EVASIVE', peer=receiver.uuid, name='receiver'))
+        await spool.whisper('receiver', 'maybe lost')
+        old_uuid = receiver.uuid
+        await receiver.stop()
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(spool), 1)
+        await spool.whisper(old_uuid, 'after restart')
+        receiver = Node('receiver', mesh=mesh, loop=self.loop)
+        await receiver.start()
+        await asyncio.sleep(0.05)
+        whispers = [msg for msg in await self.drain(receiver) if msg.event == 'WHISPER']
+        self.assertEqual([msg.blob for msg in whispers], [b'maybe lost', b'after restart'])
+        await receiver.stop()
+
+        # Oldest entries are dropped when there is no room, and once too old
+        for i in range(200):
+            await spool.whisper('nobody', 'msg %03d' % i)
+        self.assertEqual(spool.dropped, 200 - len(spool))
+        self.assertGreater(len(spool), 150)
+        spool.max_age_ms = 10
+        await asyncio.sleep(0.02)
+        await spool.whisper('nobody', 'fresh')
+        self.assertEqual(len(spool), 1)
+        self.assertEqual(spool.dropped, 200)
+        spool.close()
+        await sender.stop()
+        await asyncio.wait(listening)
+
+    async def blocking(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        a, b = await self.start(mesh, 2, headers={'role': 'worker'}, trace=True)
+        await asyncio.sleep(0.05)
+        await self.drain(b)
+        sender = BlockingNode(a, timeout=1)
+        receiver = BlockingNode(b, receive=True, timeout=1)
+
+        def produce(i):
+            sender.whisper(b.uuid, 'Hello from thread %d' % i)
+
+        def work():
+            sender.join('threads')
+            self.assertEqual(sender.own_groups(), {'threads'})
+            self.assertEqual(sender.peers(), {b.uuid})
+            self.assertEqual(sender.peer_header_value(b.uuid, 'role'), 'worker')
+            sender.shout('threads', 'Hello threads')
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                list(executor.map(produce, range(8)))
+            received = [receiver.recv(timeout=1) for _ in range(9)]
+            with self.assertRaises(TimeoutError):
+                receiver.recv(timeout=0.01)
+            return received
+
+        received = await self.loop.run_in_executor(None, work)
+        self.assertEqual(received[0].event, 'JOIN')
+        self.assertEqual(
+            sorted(msg.blob for msg in received[1:]), sorted(b'Hello from thread %d' % i for i in range(8)))
+        # Messages now go to the receive queue rather than Node.recv()
+        with self.assertRaises(asyncio.TimeoutError):
+            await b.recv(timeout=0.05)
+
+        # Protocol messages are handled by the node's filters, and only their payloads received
+        listening = self.loop.create_task(self.consume(a))
+        receiving = self.loop.run_in_executor(None, receiver.recv, 1)
+        await a.whisper_reliable(b.uuid, 'Reliably', timeout=1)
+        self.assertEqual((await receiving).blob, b'Reliably')
+        # Spool and GroupState need to see every message
+        GroupState(a, 'threads')
+        with self.assertRaises(ValueError):
+            BlockingNode(a, receive=True)
+
+        await a.stop()
+        await listening
+        with self.assertRaises(Stopped):
+            sender.peers()
+        await b.stop()
+        with self.assertRaises(Stopped):
+            while True:
+                receiver.recv(timeout=1)
+
+    async def stop_drain(self):
+        mesh = Mesh(latency_ms=1, seed=0)
+        a, b, c = await self.start(mesh, 3)
+        await asyncio.sleep(0.05)
+        await self.drain(b)
+        # Queued whispers are all handed over before a draining stop
+        for i in range(100):
+            a.whisper_nowait(b.uuid, 'Hello %d' % i)
+        report = await a.stop(drain=True, timeout=1)
+        self.assertIsInstance(report, StopReport)
+        self.assertEqual(report.drained, 100)
+        self.assertFalse(report.timed_out)
+        self.assertEqual(report.dropped, [])
+        with self.assertRaises(Stopped):
+            await a.shout('all', 'Too late')
+        with self.assertRaises(Stopped):
+            a.whisper_nowait(b.uuid, 'Too late')
+        await asyncio.sleep(0.05)
+        # Without draining, queued whispers are failed and reported
+        pending = [c.whisper_nowait(b.uuid, 'Lost %d' % i) for i in range(10)]
+        report = await c.stop()
+        self.assertEqual(report.drained, 0)
+        self.assertEqual(len(report.dropped), 10)
+        for fut in pending:
+            with self.assertRaises(Stopped):
+                await fut
+        # A draining stop reports the messages b hasn't read, and recv() then raises Stopped
+        report = await b.stop(drain=True)
+        whispers = [msg.string for msg in report.unread if msg.event == 'WHISPER']
+        self.assertEqual(whispers, ['Hello %d' % i for i in range(100)])
+        with self.assertRaises(Stopped):
+            await b.recv()
+
+        # Otherwise they remain readable until Stopped
+        d, e = await self.start(mesh, 2)
+        await asyncio.sleep(0.05)
+        await d.whisper(e.uuid, 'Still here')
+        await asyncio.sleep(0.05)
+        await d.stop()
+        report = await e.stop()
+        self.assertEqual(report.unread, [])
+        whispered = False
+        with self.assertRaises(Stopped):
+            while True:
+                msg = await e.recv()
+                if msg.event == 'WHISPER':
+                    self.assertEqual(msg.blob, b'Still here')
+                    whispered = True
+        self.assertTrue(whispered)
+
+        # Messages queued for a BlockingNode are reported too, and its recv() then raises Stopped
+        f, g = await self.start(mesh, 2)
+        await asyncio.sleep(0.05)
+        receiver = BlockingNode(g, receive=True)
+        await f.whisper(g.uuid, 'Queued')
+        await asyncio.sleep(0.05)
+        await f.stop()
+        report = await g.stop(drain=True)
+        self.assertEqual([msg.blob for msg in report.unread if msg.event == 'WHISPER'], [b'Queued'])
+        with self.assertRaises(Stopped):
+            receiver.recv(timeout=0)
+
+
+class NodeConfigTestCase(unittest.TestCase):
+    def test_gossip(self):
+        self.assertEqual(NodeConfig('node').gossip(), (None, []))
+        config = NodeConfig('node', gossip_connect='inproc://hub')
+        self.assertEqual(config.gossip_connect, ['inproc://hub'])
+        self.assertEqual(config.gossip(), (None, ['inproc://hub']))
+        config = NodeConfig('node', gossip_connect=('inproc://hub1', 'inproc://hub2'))
+        self.assertEqual(config.gossip(), (None, ['inproc://hub1', 'inproc://hub2']))
+        # gossip_endpoint binds and connects
+        config = NodeConfig('node', gossip_endpoint='inproc://gossip')
+        self.assertEqual(config.gossip(), ('inproc://gossip', ['inproc://gossip']))
+        # ...but an explicit gossip_bind takes precedence, and gossip_connect is kept
+        config = NodeConfig(
+            'node', gossip_endpoint='inproc://gossip', gossip_bind='inproc://hub', gossip_connect=['inproc://other'])
+        self.assertEqual(config.gossip(), ('inproc://hub', ['inproc://other', 'inproc://gossip']))
+        self.assertEqual(config.gossip_connect, ['inproc://other'])
+
+
 if __name__ == '__main__':
     unittest.main()